@@ -13,32 +13,51 @@
 #   "llama-index-readers-file>=0.5",
 #   "mcp[cli]>=2.0",
 #   "msgpack>=1.0",
+#   "numpy",
 #   "pathspec",
 #   "pypdf>=4.0",
 #   "python-docx>=1.1",
-#   "rank-bm25>=0.2",
 #   "tqdm>=4.0",
 #   "tree-sitter-languages>=1.10",
 #   "tree-sitter>=0.21",
 #   "tree_sitter_language_pack",
 #   "uvicorn[standard]>=0.29",
+#   "watchdog>=4.0",
 # ]
 # ///
 
 import argparse
 import asyncio
+import bisect
+import codecs
+import collections
+import collections.abc
 import concurrent.futures
+import concurrent.futures.process
 import contextlib
+import contextvars
+import functools
 import hashlib
+import io
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import resource
 import shutil
 import signal
+import sqlite3
 import subprocess
+import tempfile
 import threading
-from collections.abc import Generator
+import time
+import zlib
+from collections.abc import Callable, Generator, Iterable, Iterator
 from pathlib import Path
 
 import cachetools
@@ -51,12 +70,16 @@ import httpx
 import mcp.server.stdio
 import mcp.server.streamable_http_manager
 import msgpack
+import numpy as np
 import pathspec
-import rank_bm25
+import pypdf
+import starlette.background
 import starlette.responses
 import starlette.routing
 import tqdm
 import uvicorn
+import watchdog.events
+import watchdog.observers
 from llama_index.core.node_parser import CodeSplitter
 from llama_index.core.schema import Document
 from llama_index.embeddings.ollama import OllamaEmbedding
@@ -125,27 +148,410 @@ class SourceConfig:
         self.dir_suffixes = dir_suffixes
 
 
-class BM25Index:
-    def __init__(self, bm25: rank_bm25.BM25Okapi, documents: list[str], metadatas: list[dict]):
-        """Create a BOW index"""
+BM25_COMPACT_RATIO = 0.2
+
+
+def tokenize_bm25(text: str) -> list[str]:
+    return text.lower().split()
+
+
+class SparseBM25:
+    """
+    Okapi BM25 over a term-major CSR matrix, so a query only touches the
+    postings of its own terms.  Scores match rank_bm25.BM25Okapi.
+    """
+
+    def __init__(
+        self, vocab: dict[str, int], indptr: np.ndarray, indices: np.ndarray,
+        tfs: np.ndarray, doc_lengths: np.ndarray, idf: np.ndarray | None = None,
+        average_idf: float | None = None,
+        k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+    ):
+        """Create a BM25 scorer from CSR postings"""
+        self.vocab = vocab
+        self.indptr = indptr
+        self.indices = indices
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.num_docs = len(doc_lengths)
+        self.total_length = float(doc_lengths.sum())
+        avgdl = self.total_length / self.num_docs if self.num_docs else 0.0
+        self.norms = k1 * (1 - b + b * doc_lengths / (avgdl or 1.0))
+        if idf is None or average_idf is None:
+            df = np.diff(indptr).astype(np.float64)
+            idf = np.log(self.num_docs - df + 0.5) - np.log(df + 0.5)
+            average_idf = float(idf.mean()) if len(idf) else 0.0
+            idf[idf < 0] = epsilon * average_idf
+        self.idf = idf
+        self.average_idf = average_idf
+
+    @classmethod
+    def from_tokenized(cls, tokenized: list[list[str]]) -> 'SparseBM25':
+        vocab: dict[str, int] = {}
+        term_ids: list[int] = []
+        doc_ids: list[int] = []
+        counts: list[int] = []
+        doc_lengths = np.zeros(len(tokenized), dtype=np.float32)
+        for doc_id, tokens in enumerate(tokenized):
+            doc_lengths[doc_id] = len(tokens)
+            for term, count in collections.Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc_id)
+                counts.append(count)
+        term_array = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_array, kind='stable')
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_array, minlength=len(vocab)), out=indptr[1:])
+        return cls(
+            vocab, indptr,
+            np.asarray(doc_ids, dtype=np.int32)[order],
+            np.asarray(counts, dtype=np.float32)[order],
+            doc_lengths)
+
+    def postings(self, token: str) -> tuple[np.ndarray, np.ndarray]:
+        term_id = self.vocab.get(token)
+        if term_id is None:
+            return self.indices[:0], self.tfs[:0]
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.indices[start:end], self.tfs[start:end]
+
+    def get_scores(self, tokens: list[str]) -> np.ndarray:
+        scores = np.zeros(self.num_docs)
+        for token in tokens:
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            docs, tf = self.postings(token)
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.norms[docs])
+        return scores
+
+
+class PackedSequence(collections.abc.Sequence):
+    """
+    A read-only list stored as one (usually memory-mapped) buffer and an
+    array of offsets into it.  Items are decoded when they are accessed.
+    """
+
+    def __init__(self, buffer, offsets: np.ndarray, decode):
+        """Wrap a buffer and item offsets"""
+        self.buffer = buffer
+        self.offsets = offsets
+        self.decode = decode
+
+    def __len__(self) -> int:
+        return max(0, len(self.offsets) - 1)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self.decode(self.buffer[int(self.offsets[idx]):int(self.offsets[idx + 1])])
+
+
+class ConcatSequence(collections.abc.Sequence):
+    """A read-only view of two sequences one after the other."""
+
+    def __init__(self, first: collections.abc.Sequence, second: collections.abc.Sequence):
+        """Join two sequences"""
+        self.first = first
+        self.second = second
+
+    def __len__(self) -> int:
+        return len(self.first) + len(self.second)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < len(self.first):
+            return self.first[idx]
+        return self.second[idx - len(self.first)]
+
+
+class BM25Segment:
+    """
+    An immutable run of chunks and their postings.  generation names the
+    files the segment was saved to, or is None if it has not been saved.
+    """
+
+    def __init__(
+        self, bm25: SparseBM25, documents: collections.abc.Sequence[str],
+        metadatas: collections.abc.Sequence[dict], ids: collections.abc.Sequence[str],
+        path_ids: np.ndarray, generation: str | None = None,
+    ):
+        """Create a segment"""
         self.bm25 = bm25
         self.documents = documents
         self.metadatas = metadatas
+        self.ids = ids
+        self.path_ids = path_ids
+        self.generation = generation
+        self._id_lookup: dict[str, int] | None = None
+
+    @classmethod
+    def from_chunks(
+        cls, documents: list[str], metadatas: list[dict], ids: list[str],
+        path_lookup: dict[str, int],
+    ) -> 'BM25Segment':
+        path_ids = np.asarray([
+            path_lookup.setdefault(meta.get('file_path', ''), len(path_lookup))
+            for meta in metadatas], dtype=np.int32)
+        return cls(
+            SparseBM25.from_tokenized([tokenize_bm25(doc) for doc in documents]),
+            documents, metadatas, ids, path_ids)
+
+    def doc_id_for_chunk(self, chunk_id: str) -> int | None:
+        if self._id_lookup is None:
+            self._id_lookup = {cid: idx for idx, cid in enumerate(self.ids)}
+        return self._id_lookup.get(chunk_id)
+
+
+class BM25Index:
+    """
+    A BM25 index over the chunks of a collection, with a delta segment for
+    added chunks and an active mask for removed ones.
+    """
+
+    def __init__(
+        self, main: BM25Segment, delta: BM25Segment | None = None,
+        active: np.ndarray | None = None, paths: list[str] | None = None,
+    ):
+        """Create a BOW index"""
+        self.main = main
+        self.delta = delta
+        self.segments = [main] if delta is None else [main, delta]
+        self.num_docs = sum(len(segment.documents) for segment in self.segments)
+        self.active = np.ones(self.num_docs, dtype=bool) if active is None else active
+        self.paths = list(paths or [])
+        self.path_lookup = {path: idx for idx, path in enumerate(self.paths)}
+        self._file_offsets: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        if delta is None:
+            self.documents = main.documents
+            self.metadatas = main.metadatas
+            self.path_ids = main.path_ids
+        else:
+            self.documents = ConcatSequence(main.documents, delta.documents)
+            self.metadatas = ConcatSequence(main.metadatas, delta.metadatas)
+            self.path_ids = np.concatenate([main.path_ids, delta.path_ids])
+
+    @classmethod
+    def from_chunks(
+        cls, documents: list[str], metadatas: list[dict], ids: list[str],
+    ) -> 'BM25Index':
+        path_lookup: dict[str, int] = {}
+        main = BM25Segment.from_chunks(documents, metadatas, ids, path_lookup)
+        return cls(main, paths=list(path_lookup))
+
+    def get_scores(self, tokens: list[str]) -> np.ndarray:
+        main = self.main.bm25
+        if self.delta is None:
+            scores = main.get_scores(tokens)
+        else:
+            scores = np.zeros(self.num_docs)
+            parts = [(main, 0), (self.delta.bm25, main.num_docs)]
+            avgdl = (main.total_length + self.delta.bm25.total_length) / self.num_docs or 1.0
+            for token in tokens:
+                hits = [(bm25, offset, *bm25.postings(token)) for bm25, offset in parts]
+                df = sum(len(docs) for _, _, docs, _ in hits)
+                if not df:
+                    continue
+                idf = math.log(self.num_docs - df + 0.5) - math.log(df + 0.5)
+                if idf < 0:
+                    idf = main.epsilon * main.average_idf
+                for bm25, offset, docs, tf in hits:
+                    norms = bm25.k1 * (1 - bm25.b + bm25.b * bm25.doc_lengths[docs] / avgdl)
+                    scores[docs + offset] += idf * tf * (bm25.k1 + 1) / (tf + norms)
+        scores *= self.active
+        return scores
+
+    def top_n(
+        self, tokens: list[str], n: int, doc_ids: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the ids and scores of the n best scoring active documents,
+        optionally among doc_ids only.
+        """
+        scores = self.get_scores(tokens)
+        candidates = np.flatnonzero(scores > 0)
+        if doc_ids is not None:
+            candidates = np.intersect1d(candidates, doc_ids, assume_unique=True)
+        if n <= 0:
+            candidates = candidates[:0]
+        elif len(candidates) > n:
+            candidates = np.sort(candidates[np.argpartition(-scores[candidates], n - 1)[:n]])
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return candidates, scores[candidates]
+
+    def doc_ids_for_path(self, file_path: str) -> np.ndarray:
+        path_id = self.path_lookup.get(file_path)
+        if path_id is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero((self.path_ids == path_id) & self.active)
+
+    def file_chunk_offsets(
+        self, file_path: str,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return the doc ids, byte offsets and starting lines of the active
+        chunks of a file.
+        """
+        offsets = self._file_offsets.get(file_path)
+        if offsets is None:
+            doc_ids = self.doc_ids_for_path(file_path)
+            metas = [self.metadatas[doc_id] for doc_id in doc_ids.tolist()]
+            offsets = self._file_offsets[file_path] = (
+                doc_ids,
+                np.asarray([meta.get('byte_offset', 0) for meta in metas], dtype=np.int64),
+                np.asarray([meta.get('line_start', 0) for meta in metas], dtype=np.int64))
+        return offsets
+
+    def load_file_offsets(self) -> None:
+        """Compute the file_chunk_offsets of every file in one pass."""
+        doc_ids = np.flatnonzero(self.active)
+        if not len(doc_ids):
+            return
+        metas = [self.metadatas[doc_id] for doc_id in doc_ids.tolist()]
+        byte_offsets = np.asarray([meta.get('byte_offset', 0) for meta in metas], dtype=np.int64)
+        line_starts = np.asarray([meta.get('line_start', 0) for meta in metas], dtype=np.int64)
+        order = np.argsort(self.path_ids[doc_ids], kind='stable')
+        path_ids, starts = np.unique(self.path_ids[doc_ids][order], return_index=True)
+        for path_id, group in zip(path_ids.tolist(), np.split(order, starts[1:]), strict=True):
+            self._file_offsets[self.paths[path_id]] = (
+                doc_ids[group], byte_offsets[group], line_starts[group])
+
+    def doc_id_for_chunk(self, chunk_id: str) -> int | None:
+        doc_id = self.main.doc_id_for_chunk(chunk_id)
+        if doc_id is None and self.delta is not None:
+            doc_id = self.delta.doc_id_for_chunk(chunk_id)
+            if doc_id is not None:
+                doc_id += len(self.main.documents)
+        return doc_id
+
+    def updated(
+        self, deactivate_ids: Iterable[str], activate_ids: Iterable[str],
+        new_chunks: dict[str, tuple[str, dict]],
+    ) -> 'BM25Index':
+        """
+        Return a copy of the index with chunks deactivated and activated by
+        chunk id, adding new_chunks to the delta segment.
+        """
+        active = self.active.copy()
+        for chunk_id in deactivate_ids:
+            doc_id = self.doc_id_for_chunk(chunk_id)
+            if doc_id is not None:
+                active[doc_id] = False
+        added: dict[str, tuple[str, dict]] = {}
+        for chunk_id in activate_ids:
+            doc_id = self.doc_id_for_chunk(chunk_id)
+            if doc_id is not None:
+                active[doc_id] = True
+            elif chunk_id in new_chunks:
+                added[chunk_id] = new_chunks[chunk_id]
+        if not added:
+            return BM25Index(self.main, self.delta, active, self.paths)
+        old = self.delta
+        path_lookup = dict(self.path_lookup)
+        delta = BM25Segment.from_chunks(
+            (list(old.documents) if old else []) + [text for text, _ in added.values()],
+            (list(old.metadatas) if old else []) + [meta for _, meta in added.values()],
+            (list(old.ids) if old else []) + list(added),
+            path_lookup)
+        active = np.concatenate([active, np.ones(len(added), dtype=bool)])
+        return BM25Index(self.main, delta, active, list(path_lookup))
+
+    def needs_compaction(self) -> bool:
+        inactive = self.num_docs - int(np.count_nonzero(self.active))
+        delta = len(self.delta.documents) if self.delta is not None else 0
+        return (inactive > BM25_COMPACT_RATIO * self.num_docs or
+                delta > BM25_COMPACT_RATIO * len(self.main.documents))
+
+    def compacted(self) -> 'BM25Index':
+        """Return a single-segment index of only the active chunks."""
+        keep = np.flatnonzero(self.active).tolist()
+        ids = self.main.ids if self.delta is None else ConcatSequence(self.main.ids, self.delta.ids)
+        return BM25Index.from_chunks(
+            [self.documents[i] for i in keep],
+            [self.metadatas[i] for i in keep],
+            [ids[i] for i in keep])
 
 
 config: argparse.Namespace
 source_configs: list[SourceConfig] = []
 mcp_manager: mcp.server.streamable_http_manager.StreamableHTTPSessionManager | None = None
 bm25_cache: dict[str, BM25Index] = {}
+query_embedding_cache: cachetools.TTLCache | None = None
+cache_lock = threading.Lock()
+cache_stats: collections.Counter = collections.Counter()
+retrieval_cache: cachetools.TTLCache | None = None
+collection_generations: collections.Counter = collections.Counter()
+source_freshness: dict[str, tuple[str, float]] = {}
+freshness_pending: set[str] = set()
+chroma_clients: dict[str, chromadb.ClientAPI] = {}
+collection_handles: dict[str, chromadb.Collection] = {}
+http_client: httpx.Client | None = None
+async_http_client: httpx.AsyncClient | None = None
+model_info_cache: dict[tuple[str, str], dict] = {}
+git_repos: dict[str, tuple[git.Repo, threading.Lock]] = {}
+extraction_pool: concurrent.futures.ProcessPoolExecutor | None = None
+extraction_pool_lock = threading.Lock()
+stage_metrics: dict[str, dict] = {}
+request_timings: contextvars.ContextVar[dict[str, float] | None] = contextvars.ContextVar(
+    'request_timings', default=None)
+MODEL_CHANGING_PATHS = {'api/pull', 'api/create', 'api/copy', 'api/delete'}
+CHAT_LOG_PREFIX_BYTES = 64 * 1024
+STREAM_DOCUMENT_BYTES = 4 * 1024 * 1024
+STREAM_READ_SIZE = 64 * 1024
+EXTRACTED_TEXT_CACHE_BYTES = 16 * 1024 * 1024
+STREAM_SEGMENT_CHUNKS = 1024
+STAGE_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.http_max_connections,
+        max_keepalive_connections=config.http_max_keepalive,
+        keepalive_expiry=config.http_keepalive_expiry)
+
+
+def get_http_client() -> httpx.Client:
+    global http_client
+
+    with cache_lock:
+        if http_client is None:
+            http_client = httpx.Client(timeout=None, limits=http_limits())
+        return http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    global async_http_client
+
+    if async_http_client is None:
+        async_http_client = httpx.AsyncClient(timeout=None, limits=http_limits())
+    return async_http_client
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app):
-    if mcp_manager is not None:
-        async with mcp_manager.run():
+    global async_http_client
+
+    async_http_client = httpx.AsyncClient(timeout=None, limits=http_limits())
+    try:
+        if mcp_manager is not None:
+            async with mcp_manager.run():
+                yield
+        else:
             yield
-    else:
-        yield
+    finally:
+        await async_http_client.aclose()
+        async_http_client = None
 
 app = fastapi.FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -155,54 +561,222 @@ app.add_middleware(
 )
 
 shutdown_event = threading.Event()
+ready_event = threading.Event()
 build_locks_mutex = threading.Lock()
 build_locks: dict[str, threading.Lock] = {}
 
 
+FILE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    git_commit TEXT NOT NULL DEFAULT '',
+    git_filters TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    collection_id INTEGER NOT NULL REFERENCES collections (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    active_sha TEXT NOT NULL DEFAULT '',
+    UNIQUE (collection_id, path)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    sha TEXT NOT NULL,
+    UNIQUE (file_id, sha)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    version_id INTEGER NOT NULL REFERENCES versions (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    chunk_id TEXT NOT NULL,
+    PRIMARY KEY (version_id, seq)
+) WITHOUT ROWID;
+"""
+
+file_index_local = threading.local()
+
+
 def file_index_lock(data_dir: Path) -> filelock.FileLock:
     return filelock.FileLock(data_dir / 'file_index.lock', timeout=60)
 
 
-def file_atomic_write(path: Path, data: str) -> None:
-    tmp = path.with_suffix('.tmp.' + str(os.getpid()))
+def file_index_db(data_dir: Path) -> sqlite3.Connection:
+    """
+    Return this thread's connection to the SQLite file index of a data
+    directory, creating or migrating it on first use.
+    """
+    connections = getattr(file_index_local, 'connections', None)
+    if connections is None:
+        connections = file_index_local.connections = {}
+    key = str(data_dir)
+    if key not in connections:
+        data_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            data_dir / 'file_index.sqlite3', timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.executescript(FILE_INDEX_SCHEMA)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(collections)')}
+        for column in ('git_commit', 'git_filters'):
+            if column not in columns:
+                conn.execute(
+                    f"ALTER TABLE collections ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        migrate_json_file_index(data_dir, conn)
+        connections[key] = conn
+    return connections[key]
+
+
+@contextlib.contextmanager
+def file_index_transaction(data_dir: Path) -> Generator[sqlite3.Connection, None, None]:
+    conn = file_index_db(data_dir)
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        tmp.write_text(data)
-        try:
-            tmp.replace(path)
-        except OSError:
-            shutil.copy2(str(tmp), str(path))
-            tmp.unlink(missing_ok=True)
+        yield conn
     except BaseException:
-        tmp.unlink(missing_ok=True)
+        conn.execute('ROLLBACK')
         raise
+    conn.execute('COMMIT')
 
 
-def load_file_index(data_dir: Path, held_lock: filelock.FileLock | None = None) -> dict:
+def migrate_json_file_index(data_dir: Path, conn: sqlite3.Connection) -> None:
     path = data_dir / 'file_index.json'
-    if held_lock is not None:
-        return json.loads(path.read_text()) if path.exists() else {}
+    if not path.exists():
+        return
     with file_index_lock(data_dir):
-        return json.loads(path.read_text()) if path.exists() else {}
+        if not path.exists():
+            return
+        if conn.execute('SELECT COUNT(*) FROM collections').fetchone()[0] == 0:
+            index = json.loads(path.read_text())
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for cname, coll_entry in index.items():
+                    write_collection_entry(conn, cname, coll_entry)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            logger.info('migrated file_index.json (%d collections) to SQLite', len(index))
+        path.replace(path.with_suffix('.json.migrated'))
+
+
+def file_index_collection_id(
+    conn: sqlite3.Connection, cname: str, create: bool = False,
+) -> int | None:
+    if create:
+        conn.execute('INSERT OR IGNORE INTO collections (name) VALUES (?)', (cname,))
+    row = conn.execute('SELECT id FROM collections WHERE name = ?', (cname,)).fetchone()
+    return row[0] if row else None
+
+
+def write_file_entry(
+    conn: sqlite3.Connection, coll_id: int, file_path: str, file_entry: dict,
+) -> None:
+    conn.execute(
+        'INSERT INTO files (collection_id, path, active_sha) VALUES (?, ?, ?) '
+        'ON CONFLICT (collection_id, path) DO UPDATE SET active_sha = excluded.active_sha',
+        (coll_id, file_path, file_entry.get('active_sha', '')))
+    file_id = conn.execute(
+        'SELECT id FROM files WHERE collection_id = ? AND path = ?',
+        (coll_id, file_path)).fetchone()[0]
+    versions = file_entry.get('versions', {})
+    existing = dict(conn.execute('SELECT sha, id FROM versions WHERE file_id = ?', (file_id,)))
+    for sha, version_id in existing.items():
+        if sha not in versions:
+            conn.execute('DELETE FROM versions WHERE id = ?', (version_id,))
+    for sha, chunk_ids in versions.items():
+        if sha in existing:
+            continue
+        version_id = conn.execute(
+            'INSERT INTO versions (file_id, sha) VALUES (?, ?)', (file_id, sha)).lastrowid
+        conn.executemany(
+            'INSERT INTO chunks (version_id, seq, chunk_id) VALUES (?, ?, ?)',
+            ((version_id, seq, chunk_id) for seq, chunk_id in enumerate(chunk_ids)))
+
+
+def write_collection_entry(conn: sqlite3.Connection, cname: str, coll_entry: dict) -> None:
+    conn.execute('DELETE FROM collections WHERE name = ?', (cname,))
+    coll_id = file_index_collection_id(conn, cname, create=True)
+    for file_path, file_entry in coll_entry.get('files', {}).items():
+        write_file_entry(conn, coll_id, file_path, file_entry)
+
+
+def read_collection_entry(conn: sqlite3.Connection, coll_id: int) -> dict:
+    files: dict[str, dict] = {}
+    for file_path, active_sha in conn.execute(
+            'SELECT path, active_sha FROM files WHERE collection_id = ?', (coll_id,)):
+        files[file_path] = {'active_sha': active_sha, 'versions': {}}
+    for file_path, sha in conn.execute(
+            'SELECT f.path, v.sha FROM versions v JOIN files f ON f.id = v.file_id '
+            'WHERE f.collection_id = ?', (coll_id,)):
+        files[file_path]['versions'][sha] = []
+    for file_path, sha, chunk_id in conn.execute(
+            'SELECT f.path, v.sha, c.chunk_id FROM chunks c '
+            'JOIN versions v ON v.id = c.version_id JOIN files f ON f.id = v.file_id '
+            'WHERE f.collection_id = ? ORDER BY c.version_id, c.seq', (coll_id,)):
+        files[file_path]['versions'][sha].append(chunk_id)
+    return {'files': files}
+
+
+def load_collection_index(data_dir: Path, cname: str) -> dict:
+    conn = file_index_db(data_dir)
+    coll_id = file_index_collection_id(conn, cname, create=True)
+    return read_collection_entry(conn, coll_id)
+
+
+def load_active_hashes(data_dir: Path, cname: str) -> dict[str, str]:
+    """Return the active sha of each indexed file without loading chunk ids."""
+    return dict(file_index_db(data_dir).execute(
+        "SELECT f.path, f.active_sha FROM files f JOIN collections c ON c.id = f.collection_id "
+        "WHERE c.name = ? AND f.path != '__manifest__' AND f.active_sha != ''", (cname,)))
+
+
+def indexed_chunk_ids(data_dir: Path, cname: str, chunk_ids: list[str]) -> set[str]:
+    """Return the given chunk ids that some version of a collection's files refers to."""
+    conn = file_index_db(data_dir)
+    found = set()
+    for start in range(0, len(chunk_ids), 500):
+        part = chunk_ids[start:start + 500]
+        found.update(row[0] for row in conn.execute(
+            'SELECT c.chunk_id FROM chunks c JOIN versions v ON v.id = c.version_id '
+            'JOIN files f ON f.id = v.file_id JOIN collections k ON k.id = f.collection_id '
+            'WHERE k.name = ? AND c.chunk_id IN (%s)' % ','.join('?' * len(part)),
+            [cname, *part]))
+    return found
+
+
+def load_indexed_commit(data_dir: Path, cname: str) -> tuple[str, str]:
+    """
+    Return the git commit a collection was last synced to and the
+    fingerprint of the path filters used for it, or ('', '').
+    """
+    row = file_index_db(data_dir).execute(
+        'SELECT git_commit, git_filters FROM collections WHERE name = ?', (cname,)).fetchone()
+    return (row[0], row[1]) if row else ('', '')
 
 
-def save_file_index(
-    data_dir: Path, index: dict, held_lock: filelock.FileLock | None = None,
-) -> None:
-    path = data_dir / 'file_index.json'
-    path.parent.mkdir(parents=True, exist_ok=True)
-    if held_lock is not None:
-        file_atomic_write(path, json.dumps(index))
-    else:
-        with file_index_lock(data_dir):
-            file_atomic_write(path, json.dumps(index))
+def save_indexed_commit(data_dir: Path, cname: str, commit: str, filters: str) -> None:
+    with file_index_transaction(data_dir) as conn:
+        coll_id = file_index_collection_id(conn, cname, create=True)
+        conn.execute(
+            'UPDATE collections SET git_commit = ?, git_filters = ? WHERE id = ?',
+            (commit, filters, coll_id))
 
 
 def save_file_index_entry(data_dir: Path, cname: str, coll_entry: dict) -> None:
-    lock = file_index_lock(data_dir)
-    with lock:
-        index = load_file_index(data_dir, held_lock=lock)
-        index[cname] = coll_entry
-        save_file_index(data_dir, index, held_lock=lock)
+    with file_index_transaction(data_dir) as conn:
+        write_collection_entry(conn, cname, coll_entry)
+
+
+def save_file_entries(data_dir: Path, cname: str, file_entries: dict[str, dict]) -> None:
+    """Upsert the entries of some files of a collection in one transaction."""
+    if not file_entries:
+        return
+    with file_index_transaction(data_dir) as conn:
+        coll_id = file_index_collection_id(conn, cname, create=True)
+        for file_path, file_entry in file_entries.items():
+            write_file_entry(conn, coll_id, file_path, file_entry)
 
 
 def make_pathspec(exclude: str) -> pathspec.PathSpec:
@@ -218,15 +792,19 @@ def list_paths(
     spec = make_pathspec(exclude)
     for p in sorted(source.rglob('*')):
         try:
-            if p.is_file() and p.suffix.lower() in suffixes:
-                if p.name in SKIP_FILES:
-                    continue
-                if not spec.match_file(p.relative_to(base).as_posix()):
-                    yield p
+            if p.is_file() and path_included(base, p, suffixes, spec):
+                yield p
         except Exception:
             pass
 
 
+def path_included(
+    base: Path, p: Path, suffixes: list[str], spec: pathspec.PathSpec,
+) -> bool:
+    return (p.suffix.lower() in suffixes and p.name not in SKIP_FILES and
+            not spec.match_file(p.relative_to(base).as_posix()))
+
+
 def is_git_source(src: SourceConfig) -> bool:
     if src.is_file:
         return False
@@ -273,6 +851,54 @@ def current_file_hashes_for_source(src: SourceConfig) -> dict[str, str]:
     return result
 
 
+def stat_fingerprint(path: str) -> str:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '-'
+    return f'{st.st_mtime_ns}:{st.st_size}'
+
+
+def git_dir_for_source(source_path: str) -> str:
+    git_dir = os.path.join(source_path, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir) as fptr:
+            git_dir = os.path.join(source_path, fptr.read().split('gitdir:', 1)[-1].strip())
+    return git_dir
+
+
+def source_snapshot(src: SourceConfig) -> str:
+    """
+    Return a cheap fingerprint of a source that changes when files are
+    added, removed or renamed, or when git HEAD, refs or index change.
+    """
+    if src.is_file:
+        return stat_fingerprint(src.source_path)
+    parts = []
+    if is_git_source(src):
+        git_dir = git_dir_for_source(src.source_path)
+        try:
+            with open(os.path.join(git_dir, 'HEAD')) as fptr:
+                head = fptr.read().strip()
+        except OSError:
+            head = ''
+        parts.append(head)
+        if head.startswith('ref:'):
+            parts.append(stat_fingerprint(os.path.join(git_dir, head[4:].strip())))
+        for name in ('packed-refs', 'index'):
+            parts.append(stat_fingerprint(os.path.join(git_dir, name)))
+    else:
+        source = os.path.join(src.source_path, src.source_sub_path)
+        spec = make_pathspec(src.exclude)
+        for dirpath, dirnames, _ in os.walk(source):
+            rel_dir = os.path.relpath(dirpath, src.source_path).replace(os.sep, '/')
+            dirnames[:] = sorted(
+                name for name in dirnames if name != '.git' and not spec.match_file(
+                    f'{name}/' if rel_dir == '.' else f'{rel_dir}/{name}/'))
+            parts.append(f'{dirpath}:{stat_fingerprint(dirpath)}')
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
 def collection_name_for_source(
     embed_model: str, chunk_size: int, chunk_overlap: int, source_path: str,
 ) -> str:
@@ -300,26 +926,87 @@ def strip_hop_by_hop_headers(headers: dict) -> dict:
     return {k: v for k, v in headers.items() if k.lower() not in drop}
 
 
-def iter_repo_blobs(
-    source_path: str, extensions: list[str], sub_path: str, exclude: str,
-) -> Generator[git.objects.blob.Blob, None, None]:
+@contextlib.contextmanager
+def git_repo_for_source(source_path: str) -> Generator[git.Repo, None, None]:
+    """Yield the shared repo handle of a git source while holding its lock."""
+    with build_locks_mutex:
+        if source_path not in git_repos:
+            git_repos[source_path] = (git.Repo(source_path), threading.Lock())
+        repo, lock = git_repos[source_path]
+    with lock:
+        yield repo
+
+
+def git_path_filter(
+    extensions: list[str], sub_path: str, exclude: str,
+) -> Callable[[str], bool]:
     sub_path = sub_path.replace('\\', '/')
     prefix = sub_path.strip('/') + '/' if sub_path.strip('/') else ''
     spec = make_pathspec(exclude)
-    repo = git.Repo(source_path)
-    for item in sorted(repo.tree().traverse(), key=lambda i: i.path):
-        if item.type != 'blob':
-            continue
-        if prefix and not item.path.startswith(prefix):
-            continue
-        if not any(item.path.endswith(ext) for ext in extensions):
-            continue
-        if Path(item.path).name in SKIP_FILES:
-            continue
-        if not spec.match_file(item.path):
+
+    def included(path: str) -> bool:
+        return ((not prefix or path.startswith(prefix)) and
+                any(path.endswith(ext) for ext in extensions) and
+                Path(path).name not in SKIP_FILES and not spec.match_file(path))
+
+    return included
+
+
+def iter_repo_blobs(
+    source_path: str, extensions: list[str], sub_path: str, exclude: str,
+) -> Generator[git.objects.blob.Blob, None, None]:
+    included = git_path_filter(extensions, sub_path, exclude)
+    with git_repo_for_source(source_path) as repo:
+        items = sorted(repo.tree().traverse(), key=lambda i: i.path)
+    for item in items:
+        if item.type == 'blob' and included(item.path):
             yield item
 
 
+def git_filter_fingerprint(src: SourceConfig) -> str:
+    filters = [src.git_extensions, src.source_sub_path, src.exclude]
+    return hashlib.sha256(json.dumps(filters).encode()).hexdigest()
+
+
+def git_file_hashes_for_source(
+    src: SourceConfig, data_dir: Path, cname: str,
+) -> tuple[dict[str, str], str]:
+    """
+    Return the file hashes of a git source at HEAD and the HEAD commit,
+    diffing from the indexed commit when the path filters are unchanged.
+    """
+    indexed, filters = load_indexed_commit(data_dir, cname)
+    if filters != git_filter_fingerprint(src):
+        indexed = ''
+    diffs = None
+    with git_repo_for_source(src.source_path) as repo:
+        head = repo.head.commit.hexsha
+        if indexed == head:
+            return load_active_hashes(data_dir, cname), head
+        if indexed:
+            try:
+                diffs = list(repo.commit(indexed).diff(head))
+            except Exception:
+                logger.info('cannot diff from indexed commit %s; listing %s',
+                            indexed, src.source_path)
+    if diffs is None:
+        return current_file_hashes_for_source(src), head
+    included = git_path_filter(
+        [e.strip() for e in src.git_extensions.split(',')], src.source_sub_path, src.exclude)
+    hashes = load_active_hashes(data_dir, cname)
+    for diff in diffs:
+        if diff.renamed_file:
+            hashes.pop(os.path.join(src.source_path, diff.a_path), None)
+        fp = os.path.join(src.source_path, diff.b_path)
+        if (diff.b_blob is not None and diff.b_mode & 0o170000 != 0o160000 and
+                included(diff.b_path)):
+            hashes[fp] = diff.b_blob.hexsha
+        else:
+            hashes.pop(fp, None)
+    logger.info('git diff %s..%s: %d changed paths', indexed[:10], head[:10], len(diffs))
+    return hashes, head
+
+
 def load_file_docs(p: Path) -> list[Document]:
     suffix = p.suffix.lower()
     readers = {'.pdf': PDFReader, '.docx': DocxReader, '.md': MarkdownReader}
@@ -331,28 +1018,22 @@ def load_file_docs(p: Path) -> list[Document]:
             logger.warning('reading failed for %s: %s', p, str(exc)[:40])
             raise
     if suffix != '.txt':
-        proc = None
         try:
-            proc = subprocess.Popen([
-                'pandoc', str(p), '-t', 'plain', '--wrap=none'],
-                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=0)
+            proc = open_pandoc(p)
+        except FileNotFoundError:
+            proc = None
+        if proc is not None:
             chunks = []
             size = 0
-            while True:
-                chunk = proc.stdout.read(8192)
-                if not chunk:
-                    break
+            for chunk in iter_process_text(proc):
                 size += len(chunk)
                 if size > limit:
-                    proc.kill()
                     return None
                 chunks.append(chunk)
-            proc.wait(timeout=30)
-            return [Document(text=(''.join(chunks)),
-                             metadata={'file_path': str(p)})]
-        except Exception:
-            if proc is not None:
-                proc.kill()
+            if proc.returncode == 0:
+                return [Document(text=(''.join(chunks)),
+                                 metadata={'file_path': str(p)})]
+            logger.info('pandoc could not convert %s; reading it as text', p)
     if p.stat().st_size > limit:
         return None
     raw_bytes = p.read_bytes()
@@ -360,6 +1041,222 @@ def load_file_docs(p: Path) -> list[Document]:
                      metadata={'file_path': str(p)})]
 
 
+def open_pandoc(p: Path) -> subprocess.Popen:
+    return subprocess.Popen([
+        'pandoc', str(p), '-t', 'plain', '--wrap=none'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=0)
+
+
+def iter_process_text(proc: subprocess.Popen) -> Generator[str, None, None]:
+    """Yield the text output of a process in pieces, killing it if not read to the end."""
+    try:
+        while True:
+            piece = proc.stdout.read(STREAM_READ_SIZE)
+            if not piece:
+                break
+            yield piece
+        proc.wait(timeout=30)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+@functools.cache
+def pandoc_available() -> bool:
+    return shutil.which('pandoc') is not None
+
+
+def needs_extraction(p: Path) -> bool:
+    suffix = p.suffix.lower()
+    return suffix in ('.pdf', '.docx') or (suffix not in ('.txt', '.md') and pandoc_available())
+
+
+def init_extraction_worker(memory_limit: int) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit > 0:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def raise_extraction_timeout(signum, frame):
+    msg = 'extraction timed out'
+    raise TimeoutError(msg)
+
+
+def extract_document_text(path: str, spool_path: str, timeout: float) -> bool:
+    """
+    Convert a document to text in a spool file in an extraction worker,
+    with a repeating timeout.  Errors are raised as RuntimeError.
+    """
+    signal.signal(signal.SIGALRM, raise_extraction_timeout)
+    if timeout > 0:
+        signal.setitimer(signal.ITIMER_REAL, timeout, 1)
+    try:
+        with open(spool_path, 'w', encoding='utf-8', errors='surrogatepass', newline='') as out:
+            return write_document_text(Path(path), out)
+    except Exception as exc:
+        msg = str(exc)[:200] or type(exc).__name__
+        raise RuntimeError(msg) from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def write_document_text(p: Path, out: io.TextIOBase) -> bool:
+    """
+    Write the plain text of a document to out as it is extracted.  Returns
+    False if pandoc could not convert it and the raw content was written.
+    """
+    suffix = p.suffix.lower()
+    if suffix == '.pdf':
+        for idx, page in enumerate(pypdf.PdfReader(p).pages):
+            out.write(('\n' if idx else '') + page.extract_text())
+        return True
+    if suffix == '.docx':
+        out.write('\n'.join(d.text for d in load_file_docs(p)))
+        return True
+    try:
+        proc = open_pandoc(p)
+    except FileNotFoundError:
+        proc = None
+    if proc is not None:
+        for piece in iter_process_text(proc):
+            out.write(piece)
+        if proc.returncode == 0:
+            return True
+        logger.info('pandoc could not convert %s; reading it as text', p)
+        out.seek(0)
+        out.truncate()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(p, 'rb') as f:
+        while block := f.read(STREAM_READ_SIZE):
+            out.write(decoder.decode(block))
+    out.write(decoder.decode(b'', final=True))
+    return False
+
+
+def load_document_text(p: Path) -> str | None:
+    docs = load_file_docs(p)
+    return None if docs is None else '\n'.join(d.text for d in docs)
+
+
+def get_extraction_pool(
+    broken: concurrent.futures.ProcessPoolExecutor | None = None,
+) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Return the spawned process pool that extracts document text, replacing
+    it if it is the given broken pool.
+    """
+    global extraction_pool
+    with extraction_pool_lock:
+        if broken is not None and extraction_pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            extraction_pool = None
+        if extraction_pool is None:
+            extraction_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=config.extract_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_extraction_worker, initargs=(config.extract_memory_limit, ))
+        return extraction_pool
+
+
+def extract_in_pool(p: Path, spool: Path) -> bool | None:
+    """
+    Extract a document to a spool file in the process pool, retrying once
+    if the worker dies.
+    """
+    pool = get_extraction_pool()
+    for _ in range(2):
+        try:
+            return pool.submit(
+                extract_document_text, str(p), str(spool), config.extract_timeout).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            logger.warning('extraction worker died while reading %s', p)
+            pool = get_extraction_pool(pool)
+    return None
+
+
+def iter_compressed_text(data: bytes) -> Generator[str, None, None]:
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='surrogatepass')
+    while data:
+        yield decoder.decode(decompressor.decompress(data, STREAM_READ_SIZE))
+        data = decompressor.unconsumed_tail
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def extract_text_pieces(p: Path, file_sha: str) -> Iterator[str]:
+    """
+    Extract a document to a spool file, or read it from the extraction
+    cache, and return an iterator over its text in pieces.
+    """
+    key = f'{file_sha}{p.suffix.lower()}'
+    cached = load_cached_text(key)
+    if cached is not None:
+        return iter_compressed_text(cached)
+    data_dir = Path(config.data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    fd, spool = tempfile.mkstemp(prefix='extract-', suffix='.tmp', dir=data_dir)
+    os.close(fd)
+    try:
+        if config.extract_workers > 0:
+            converted = extract_in_pool(p, Path(spool))
+        else:
+            with open(spool, 'w', encoding='utf-8', errors='surrogatepass', newline='') as out:
+                converted = write_document_text(p, out)
+        if converted is None:
+            msg = f'could not extract text from {p}'
+            raise RuntimeError(msg)
+        f = open(spool, encoding='utf-8', errors='surrogatepass', newline='')
+    except Exception as exc:
+        logger.warning('extraction failed for %s: %s', p, str(exc)[:80] or type(exc).__name__)
+        raise
+    finally:
+        os.unlink(spool)
+    return iter_spool_text(f, key if converted else None)
+
+
+def iter_spool_text(f: io.TextIOBase, key: str | None) -> Generator[str, None, None]:
+    """Read extracted text from an open spool file, caching it under key if given."""
+    compressor = zlib.compressobj() if key and text_cache_enabled() else None
+    compressed, size = [], 0
+    with f:
+        while piece := f.read(STREAM_READ_SIZE):
+            if compressor is not None:
+                size += len(piece)
+                if size > EXTRACTED_TEXT_CACHE_BYTES:
+                    compressor, compressed = None, []
+                else:
+                    compressed.append(
+                        compressor.compress(piece.encode('utf-8', errors='surrogatepass')))
+            yield piece
+    if compressor is not None:
+        compressed.append(compressor.flush())
+        save_cached_text(key, b''.join(compressed))
+
+
+def iter_document_text(p: Path, file_sha: str) -> Iterator[str]:
+    """
+    Return the text of a document as an iterator of pieces; documents
+    that need extraction are extracted before this returns.
+    """
+    if needs_extraction(p):
+        return extract_text_pieces(p, file_sha)
+    return iter_file_text(p)
+
+
+def iter_file_text(p: Path) -> Generator[str, None, None]:
+    if p.suffix.lower() == '.md':
+        yield load_document_text(p)
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(p, 'rb') as f:
+        while block := f.read(STREAM_READ_SIZE):
+            yield decoder.decode(block)
+    yield decoder.decode(b'', final=True)
+
+
 def find_source_for_path(abs_path: str) -> tuple[SourceConfig, str] | None:
     """
     Given an absolute path, find the owning SourceConfig and the relative
@@ -381,19 +1278,21 @@ def find_source_for_path(abs_path: str) -> tuple[SourceConfig, str] | None:
     return best
 
 
-def load_single_file_document(abs_path: str) -> Document | None:
+def load_single_file_document(abs_path: str, file_sha: str | None = None) -> Document | None:
     found = find_source_for_path(abs_path)
     if found is None:
         return None
     src, rel_path = found
     if is_git_source(src):
         try:
-            repo = git.Repo(src.source_path)
-            blob = repo.tree() / rel_path
-            text = blob.data_stream.read().decode('utf-8', errors='replace')
-            return Document(text=text, metadata={
-                'file_path': abs_path, 'file_sha': blob.hexsha,
-                'file_size': blob.size, 'file_mtime': 0, 'rel_path': rel_path,
+            with git_repo_for_source(src.source_path) as repo:
+                if not file_sha:
+                    file_sha = (repo.tree() / rel_path).hexsha
+                stream = repo.odb.stream(bytes.fromhex(file_sha))
+                data = stream.read()
+            return Document(text=data.decode('utf-8', errors='replace'), metadata={
+                'file_path': abs_path, 'file_sha': file_sha,
+                'file_size': stream.size, 'file_mtime': 0, 'rel_path': rel_path,
             })
         except Exception:
             return None
@@ -401,12 +1300,19 @@ def load_single_file_document(abs_path: str) -> Document | None:
     if not p.is_file():
         return None
     try:
-        docs = load_file_docs(p)
+        with open(p, 'rb') as f:
+            file_sha = hashlib.file_digest(f, 'sha256').hexdigest()
+        if needs_extraction(p):
+            text = ''.join(extract_text_pieces(p, file_sha))
+        else:
+            text = load_document_text(p)
+        if text is None:
+            return None
         return Document(
-            text='\n'.join(d.text for d in docs),
+            text=text,
             metadata={
                 'file_path': abs_path,
-                'file_sha': hashlib.file_digest(open(p, 'rb'), 'sha256').hexdigest(),
+                'file_sha': file_sha,
                 'file_size': p.stat().st_size,
                 'file_mtime': p.stat().st_mtime,
                 'rel_path': rel_path,
@@ -416,6 +1322,38 @@ def load_single_file_document(abs_path: str) -> Document | None:
         return None
 
 
+def stream_document_chunks(
+    abs_path: str, chunk_size: int, chunk_overlap: int, file_sha: str | None = None,
+) -> Generator[dict, None, None] | None:
+    """
+    Return a lazy generator of the prepared chunks of a large document, or
+    None for files that are loaded whole.
+    """
+    found = find_source_for_path(abs_path)
+    if found is None or is_git_source(found[0]):
+        return None
+    src, rel_path = found
+    ext = '.' + abs_path.rsplit('.', 1)[-1] if '.' in abs_path else ''
+    p = Path(src.source_path) if src.is_file else Path(src.source_path) / rel_path
+    try:
+        st = p.stat()
+        if ext in EXTENSION_TO_LANGUAGE or st.st_size < STREAM_DOCUMENT_BYTES:
+            return None
+        if not file_sha:
+            with open(p, 'rb') as f:
+                file_sha = hashlib.file_digest(f, 'sha256').hexdigest()
+    except OSError:
+        return None
+    meta = {
+        'file_path': abs_path, 'file_sha': file_sha, 'file_size': st.st_size,
+        'file_mtime': st.st_mtime, 'rel_path': rel_path,
+    }
+    return (
+        prepare_chunk(chunk_info, meta)
+        for chunk_info in iter_text_windows(
+            iter_document_text(p, file_sha), chunk_size, chunk_overlap))
+
+
 def build_file_manifest_document(active_paths: list[str]) -> Document:
     return Document(
         text='Repository file listing:\n' + '\n'.join(sorted(active_paths)),
@@ -423,16 +1361,56 @@ def build_file_manifest_document(active_paths: list[str]) -> Document:
     )
 
 
+def model_digest(base_url: str, model_name: str) -> str:
+    """Return a model's digest as listed by /api/tags, or '' if unlisted."""
+    response = get_http_client().get(f'{base_url}/api/tags', timeout=10)
+    if response.status_code != 200:
+        return ''
+    names = {model_name} if ':' in model_name else {model_name, model_name + ':latest'}
+    for model in response.json().get('models', []):
+        if model.get('name') in names or model.get('model') in names:
+            return model.get('digest', '')
+    return ''
+
+
+def get_model_metadata(base_url: str, model_name: str) -> dict:
+    """
+    Return the digest, context length, and num_ctx parameter of a model,
+    cached until its digest changes.  Raises if the model is not available.
+    """
+    key = (base_url, model_name)
+    info = model_info_cache.get(key)
+    now = time.monotonic()
+    if info is not None and now - info['checked'] < config.model_info_ttl:
+        return info
+    digest = model_digest(base_url, model_name)
+    if info is None or not digest or digest != info['digest']:
+        response = get_http_client().post(
+            f'{base_url}/api/show', json={'name': model_name}, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        info = {'digest': digest, 'context_length': None, 'num_ctx': None}
+        for name, value in data.get('model_info', {}).items():
+            if name.endswith('.context_length'):
+                info['context_length'] = int(value)
+                break
+        for line in data.get('parameters', '').splitlines():
+            if line.strip().lower().startswith('num_ctx'):
+                info['num_ctx'] = int(line.split()[-1])
+                break
+    model_info_cache[key] = info = dict(info, checked=now)
+    return info
+
+
 def check_embed_model_available(base_url: str, model_name: str) -> None:
     try:
-        with httpx.Client(timeout=10) as client:
-            response = client.post(f'{base_url}/api/show', json={'name': model_name})
-            if response.status_code != 200:
-                msg = (
-                    f'Embedding model {model_name!r} is not available '
-                    f'(HTTP {response.status_code}).  Run: ollama pull {model_name}'
-                )
-                raise RuntimeError(msg)
+        get_model_metadata(base_url, model_name)
+    except httpx.HTTPStatusError as exc:
+        msg = (
+            f'Embedding model {model_name!r} is not available '
+            f'(HTTP {exc.response.status_code}).  Run: ollama pull {model_name}'
+        )
+        raise RuntimeError(msg) from exc
     except httpx.ConnectError as exc:
         msg = f'Could not connect to Ollama at {base_url}: {exc}'
         raise RuntimeError(msg) from exc
@@ -440,19 +1418,10 @@ def check_embed_model_available(base_url: str, model_name: str) -> None:
 
 def get_model_context_length(model_name: str) -> int:
     try:
-        with httpx.Client(timeout=10) as client:
-            data = client.post(
-                f'{config.ollama_base_url}/api/show', json={'name': model_name},
-            ).json()
-        for key, value in data.get('model_info', {}).items():
-            if key.endswith('.context_length'):
-                return int(value)
-        for line in data.get('parameters', '').splitlines():
-            if line.strip().lower().startswith('num_ctx'):
-                return int(line.split()[-1])
+        info = get_model_metadata(config.ollama_base_url, model_name)
+        return info['context_length'] or info['num_ctx'] or 2048
     except Exception:
-        pass
-    return 2048
+        return 2048
 
 
 def chunk_text(
@@ -468,6 +1437,7 @@ def chunk_text(
         ).split_text(text)
         results = []
         search_start = 0
+        counted, line_start = 0, 1
         for cidx, chunk in enumerate(raw_chunks):
             chunk_bytes = chunk.encode('utf-8', errors='ignore')
             idx = text_bytes.find(chunk_bytes, search_start)
@@ -479,25 +1449,39 @@ def chunk_text(
                     idx + len(chunk_bytes))
                 if nidx > idx:
                     chunk = text_bytes[idx:nidx].decode('utf-8', errors='ignore')
-            line_start = text_bytes[:idx].count(b'\n') + 1
+            line_start += text_bytes.count(b'\n', counted, idx)
+            counted = idx
             results.append({
                 'text': chunk, 'byte_offset': idx,
                 'line_start': line_start, 'line_end': line_start + chunk.count('\n'),
             })
             search_start = idx + len(chunk_bytes)
         return results
-    results = []
-    start = 0
-    while start < len(text):
-        chunk = text[start:min(start + chunk_size, len(text))]
-        byte_offset = len(text[:start].encode('utf-8', errors='ignore'))
-        line_start = text[:start].count('\n') + 1
-        results.append({
-            'text': chunk, 'byte_offset': byte_offset,
-            'line_start': line_start, 'line_end': line_start + chunk.count('\n'),
-        })
-        start += chunk_size - overlap
-    return results
+    return list(iter_text_windows([text], chunk_size, overlap))
+
+
+def iter_text_windows(
+    pieces: Iterable[str], chunk_size: int = 512, overlap: int = 64,
+) -> Generator[dict, None, None]:
+    """
+    Split text arriving in pieces into the same overlapping windows as the
+    joined text, holding only about one window at a time.
+    """
+    step = chunk_size - overlap
+    buf, pos, byte_offset, line_start = '', 0, 0, 1
+    for piece in itertools.chain(pieces, [None]):
+        if piece:
+            buf, pos = buf[pos:] + piece, 0
+        while pos < len(buf) and (piece is None or len(buf) - pos >= chunk_size):
+            chunk = buf[pos:pos + chunk_size]
+            yield {
+                'text': chunk, 'byte_offset': byte_offset,
+                'line_start': line_start, 'line_end': line_start + chunk.count('\n'),
+            }
+            skipped = buf[pos:pos + step]
+            byte_offset += len(skipped.encode('utf-8', errors='ignore'))
+            line_start += skipped.count('\n')
+            pos += step
 
 
 def make_chunk_id(file_sha: str, byte_offset: int, text: str) -> str:
@@ -510,41 +1494,381 @@ def check_shutdown() -> None:
         raise RuntimeError(msg)
 
 
-def embed_document_chunks(
-    doc: Document, chunk_size: int, chunk_overlap: int, embed_model: OllamaEmbedding,
-) -> tuple[list[str], list[list[float]], list[dict], list[str]]:
+def prepare_document_chunks(
+    doc: Document, chunk_size: int, chunk_overlap: int,
+) -> list[dict]:
     meta = doc.metadata or {}
+    return [
+        prepare_chunk(chunk_info, meta)
+        for chunk_info in chunk_text(
+            doc.text, chunk_size, chunk_overlap, meta.get('file_path', ''))]
+
+
+def prepare_chunk(chunk_info: dict, meta: dict) -> dict:
     file_path = meta.get('file_path', '')
     file_sha = meta.get('file_sha', '')
     rel_path = meta.get('rel_path', file_path)
-    texts, embeddings, metadatas, ids = [], [], [], []
-    for chunk_info in chunk_text(doc.text, chunk_size, chunk_overlap, file_path):
-        check_shutdown()
-        t = chunk_info['text']
-        t = t.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
-        embedding_input = f'### File: {rel_path}\n{t}' if file_path else t
-        try:
-            embedding = embed_model.get_text_embedding(embedding_input)
-        except Exception:
-            try:
-                embedding = embed_model.get_text_embedding(embedding_input.encode(
-                    'utf-8', errors='ignore').decode('utf-8', errors='ignore'))
-            except Exception:
-                embedding = None
-        if not embedding:
-            logger.warning('embedding failed for chunk in %s, skipping', file_path)
-            continue
-        texts.append(t)
-        embeddings.append(embedding)
-        metadatas.append({
+    t = chunk_info['text']
+    t = t.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+    return {
+        'text': t,
+        'input': f'### File: {rel_path}\n{t}' if file_path else t,
+        'metadata': {
             'file_path': file_path, 'file_sha': file_sha, 'rel_path': rel_path,
             'file_size': meta.get('file_size', 0), 'file_mtime': meta.get('file_mtime', 0),
             'byte_offset': chunk_info['byte_offset'],
             'line_start': chunk_info['line_start'], 'line_end': chunk_info['line_end'],
             'active': True,
-        })
-        ids.append(make_chunk_id(file_sha, chunk_info['byte_offset'], t))
-    return texts, embeddings, metadatas, ids
+        },
+        'id': make_chunk_id(file_sha, chunk_info['byte_offset'], t),
+    }
+
+
+EMBEDDING_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key BLOB PRIMARY KEY,
+    vector BLOB NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS extracted_text (
+    key TEXT PRIMARY KEY,
+    text BLOB NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    used INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+EMBEDDING_CACHE_FILES = (
+    'embedding_cache.sqlite3', 'embedding_cache.sqlite3-wal', 'embedding_cache.sqlite3-shm')
+embedding_cache_rows: dict[str, int] = {}
+extracted_text_bytes: dict[str, int] = {}
+
+
+def embedding_cache_db(data_dir: Path) -> sqlite3.Connection:
+    """
+    Return this thread's connection to the embedding cache of a data
+    directory, which also keeps extracted document text.
+    """
+    connections = getattr(file_index_local, 'embedding_connections', None)
+    if connections is None:
+        connections = file_index_local.embedding_connections = {}
+    key = str(data_dir)
+    if key not in connections:
+        data_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            data_dir / EMBEDDING_CACHE_FILES[0], timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(EMBEDDING_CACHE_SCHEMA)
+        if 'used' not in {row[1] for row in conn.execute('PRAGMA table_info(embeddings)')}:
+            conn.execute('ALTER TABLE embeddings ADD COLUMN used INTEGER NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+        if 'used' not in {row[1] for row in conn.execute('PRAGMA table_info(extracted_text)')}:
+            conn.execute('ALTER TABLE extracted_text ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+            conn.execute('ALTER TABLE extracted_text ADD COLUMN used INTEGER NOT NULL DEFAULT 0')
+            conn.execute('UPDATE extracted_text SET size = LENGTH(text)')
+        conn.execute('CREATE INDEX IF NOT EXISTS extracted_text_used ON extracted_text (used)')
+        connections[key] = conn
+    return connections[key]
+
+
+def embedding_cache_model(model_name: str) -> str:
+    """
+    Return the model part of embedding cache keys, including the model
+    digest when Ollama reports one.
+    """
+    try:
+        digest = get_model_metadata(config.ollama_base_url, model_name)['digest']
+    except Exception:
+        digest = ''
+    return f'{model_name}@{digest}' if digest else model_name
+
+
+def embedding_cache_key(model_key: str, embedding_input: str) -> bytes:
+    return hashlib.sha256(
+        f'{model_key}\0{embedding_input}'.encode('utf-8', errors='surrogatepass')).digest()
+
+
+def load_cached_embeddings(model_name: str, inputs: list[str]) -> list[list[float] | None]:
+    """Return the cached embedding of each input, or None if it has none."""
+    if not inputs or config.embedding_cache_size <= 0:
+        return [None] * len(inputs)
+    model_key = embedding_cache_model(model_name)
+    keys = [embedding_cache_key(model_key, embedding_input) for embedding_input in inputs]
+    conn = embedding_cache_db(Path(config.data_dir))
+    found = {}
+    for start in range(0, len(keys), 500):
+        part = keys[start:start + 500]
+        found.update(conn.execute(
+            'SELECT key, vector FROM embeddings WHERE key IN (%s)' % ','.join('?' * len(part)),
+            part))
+    if found:
+        used = list(found)
+        for start in range(0, len(used), 500):
+            part = used[start:start + 500]
+            conn.execute(
+                'UPDATE embeddings SET used = ? WHERE key IN (%s)' % ','.join('?' * len(part)),
+                [int(time.time()), *part])
+    with cache_lock:
+        cache_stats['embedding_cache_hits'] += len(found)
+        cache_stats['embedding_cache_misses'] += len(keys) - len(found)
+    return [
+        np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None
+        for key in keys]
+
+
+def save_cached_embeddings(
+    model_name: str, inputs: list[str], embeddings: list[list[float] | None],
+) -> None:
+    limit = config.embedding_cache_size
+    if limit <= 0:
+        return
+    model_key = embedding_cache_model(model_name)
+    now = int(time.time())
+    rows = [
+        (embedding_cache_key(model_key, embedding_input),
+         np.asarray(embedding, dtype=np.float32).tobytes(), now)
+        for embedding_input, embedding in zip(inputs, embeddings, strict=True) if embedding]
+    if not rows:
+        return
+    data_dir = Path(config.data_dir)
+    conn = embedding_cache_db(data_dir)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        added = conn.executemany(
+            'INSERT OR IGNORE INTO embeddings (key, vector, used) VALUES (?, ?, ?)', rows).rowcount
+        count = embedding_cache_rows.get(str(data_dir))
+        if count is None:
+            count = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        else:
+            count += added
+        if count - limit > limit // 10:
+            conn.execute(
+                'DELETE FROM embeddings WHERE key IN '
+                '(SELECT key FROM embeddings ORDER BY used LIMIT ?)', (count - limit, ))
+            logger.info('evicted %d least recently used cached embeddings', count - limit)
+            count = limit
+        embedding_cache_rows[str(data_dir)] = count
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def text_cache_enabled() -> bool:
+    return config.embedding_cache_size > 0 and config.extract_cache_size > 0
+
+
+def load_cached_text(key: str) -> bytes | None:
+    if not text_cache_enabled():
+        return None
+    conn = embedding_cache_db(Path(config.data_dir))
+    row = conn.execute('SELECT text FROM extracted_text WHERE key = ?', (key, )).fetchone()
+    if row is None:
+        return None
+    conn.execute('UPDATE extracted_text SET used = ? WHERE key = ?', (int(time.time()), key))
+    return row[0]
+
+
+def save_cached_text(key: str, data: bytes) -> None:
+    """
+    Cache the compressed extracted text of a document, evicting the least
+    recently used texts once the total exceeds --extract-cache-size.
+    """
+    if not text_cache_enabled():
+        return
+    limit = config.extract_cache_size * 1024 * 1024
+    data_dir = Path(config.data_dir)
+    conn = embedding_cache_db(data_dir)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        old = conn.execute('SELECT size FROM extracted_text WHERE key = ?', (key, )).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO extracted_text (key, text, size, used) VALUES (?, ?, ?, ?)',
+            (key, data, len(data), int(time.time())))
+        total = extracted_text_bytes.get(str(data_dir))
+        if total is None:
+            total = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM extracted_text').fetchone()[0]
+        else:
+            total += len(data) - (old[0] if old else 0)
+        if total - limit > limit // 10:
+            evict = []
+            for old_key, size in conn.execute(
+                    'SELECT key, size FROM extracted_text ORDER BY used').fetchall():
+                if total <= limit:
+                    break
+                evict.append((old_key, ))
+                total -= size
+            conn.executemany('DELETE FROM extracted_text WHERE key = ?', evict)
+            logger.info('evicted %d least recently used extracted texts', len(evict))
+        extracted_text_bytes[str(data_dir)] = total
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def embed_text(embed_model: OllamaEmbedding, embedding_input: str) -> list[float] | None:
+    try:
+        return embed_model.get_text_embedding(embedding_input)
+    except Exception:
+        try:
+            return embed_model.get_text_embedding(embedding_input.encode(
+                'utf-8', errors='ignore').decode('utf-8', errors='ignore'))
+        except Exception:
+            return None
+
+
+def embed_text_batch(
+    embed_model: OllamaEmbedding, inputs: list[str],
+) -> list[list[float] | None]:
+    """
+    Embed inputs with one /api/embed request, retrying them one by one if
+    the batch fails.
+    """
+    if len(inputs) > 1:
+        try:
+            embeddings = embed_model.get_text_embedding_batch(inputs)
+            if len(embeddings) == len(inputs) and all(embeddings):
+                return embeddings
+        except Exception as exc:
+            logger.debug('batch embedding of %d chunks failed (%s); retrying singly',
+                         len(inputs), str(exc)[:80])
+    return [embed_text(embed_model, embedding_input) for embedding_input in inputs]
+
+
+def embed_and_cache_batch(
+    embed_model: OllamaEmbedding, inputs: list[str],
+) -> list[list[float] | None]:
+    embeddings = embed_text_batch(embed_model, inputs)
+    save_cached_embeddings(embed_model.model_name, inputs, embeddings)
+    return embeddings
+
+
+def collect_embedded_chunks(
+    chunks: list[dict], embeddings: list[list[float] | None], file_path: str,
+) -> tuple[list[str], list[list[float]], list[dict], list[str]]:
+    texts, kept, metadatas, ids = [], [], [], []
+    for chunk, embedding in zip(chunks, embeddings, strict=True):
+        if not embedding:
+            logger.warning('embedding failed for chunk in %s, skipping', file_path)
+            continue
+        texts.append(chunk['text'])
+        kept.append(embedding)
+        metadatas.append(chunk['metadata'])
+        ids.append(chunk['id'])
+    return texts, kept, metadatas, ids
+
+
+def embed_document_chunks(
+    doc: Document, chunk_size: int, chunk_overlap: int, embed_model: OllamaEmbedding,
+) -> tuple[list[str], list[list[float]], list[dict], list[str]]:
+    chunks = prepare_document_chunks(doc, chunk_size, chunk_overlap)
+    batch_size = max(1, config.embed_batch_size)
+    embeddings = load_cached_embeddings(
+        embed_model.model_name, [chunk['input'] for chunk in chunks])
+    missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+    for start in range(0, len(missing), batch_size):
+        check_shutdown()
+        batch = missing[start:start + batch_size]
+        for idx, embedding in zip(batch, embed_and_cache_batch(
+                embed_model, [chunks[idx]['input'] for idx in batch]), strict=True):
+            embeddings[idx] = embedding
+    return collect_embedded_chunks(chunks, embeddings, (doc.metadata or {}).get('file_path', ''))
+
+
+def wait_for_embedding_batches(in_flight: dict) -> None:
+    done, _ = concurrent.futures.wait(
+        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+        members = in_flight.pop(future)
+        for (job, idx), embedding in zip(members, future.result(), strict=True):
+            job['embeddings'][idx] = embedding
+            job['remaining'] -= 1
+
+
+def pop_finished_embedding_jobs(
+    jobs: collections.deque,
+) -> Generator[tuple[str, tuple | None, bool], None, None]:
+    while jobs and not jobs[0]['remaining']:
+        job = jobs.popleft()
+        if job['chunks'] is None:
+            yield job['path'], None, True
+        else:
+            yield job['path'], collect_embedded_chunks(
+                job['chunks'], job['embeddings'], job['path']), job['final']
+
+
+def iter_chunk_segments(
+    file_path: str, chunks: Iterable[dict] | None, size: int,
+) -> Generator[tuple[list[dict] | None, bool], None, None]:
+    """
+    Split the chunks of a file into (segment, final) pairs; a failed chunk
+    iterator ends with a final segment of None.
+    """
+    if chunks is None or isinstance(chunks, list):
+        yield chunks, True
+        return
+    chunks = iter(chunks)
+    while True:
+        try:
+            segment = list(itertools.islice(chunks, size))
+        except Exception as exc:
+            logger.warning('reading failed for %s: %s', file_path, str(exc)[:80])
+            yield None, True
+            return
+        yield segment, not segment
+        if not segment:
+            return
+
+
+def embed_files_batched(
+    prepared: Iterable[tuple[str, Iterable[dict] | None]], embed_model: OllamaEmbedding,
+    batch_size: int, max_in_flight: int,
+) -> Generator[tuple[str, tuple | None, bool], None, None]:
+    """
+    Embed the chunks of many files in shared batches, yielding (path,
+    embedded or None, final) parts in input order.
+    """
+    batch_size = max(1, batch_size)
+    max_in_flight = max(1, max_in_flight)
+    jobs: collections.deque[dict] = collections.deque()
+    pending: list[tuple[dict, int]] = []
+    in_flight: dict[concurrent.futures.Future, list[tuple[dict, int]]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+
+        def submit() -> None:
+            while len(in_flight) >= max_in_flight:
+                wait_for_embedding_batches(in_flight)
+            future = executor.submit(
+                embed_and_cache_batch, embed_model,
+                [job['chunks'][idx]['input'] for job, idx in pending])
+            in_flight[future] = pending[:]
+            pending.clear()
+
+        for file_path, file_chunks in prepared:
+            for chunks, final in iter_chunk_segments(
+                    file_path, file_chunks, max(batch_size, STREAM_SEGMENT_CHUNKS)):
+                check_shutdown()
+                embeddings = load_cached_embeddings(
+                    embed_model.model_name, [chunk['input'] for chunk in chunks or []])
+                job = {
+                    'path': file_path, 'chunks': chunks, 'embeddings': embeddings,
+                    'remaining': embeddings.count(None), 'final': final,
+                }
+                jobs.append(job)
+                for idx in [idx for idx, embedding in enumerate(embeddings) if embedding is None]:
+                    pending.append((job, idx))
+                    if len(pending) >= batch_size:
+                        submit()
+                        yield from pop_finished_embedding_jobs(jobs)
+                yield from pop_finished_embedding_jobs(jobs)
+        if pending:
+            submit()
+        while in_flight:
+            check_shutdown()
+            wait_for_embedding_batches(in_flight)
+            yield from pop_finished_embedding_jobs(jobs)
 
 
 def batched_collection_op(
@@ -615,15 +1939,105 @@ def bm25_path_for_collection(data_dir: Path, cname: str) -> Path:
     return data_dir / 'bm25' / f'{cname}.msgpack'
 
 
+def bm25_data_path(data_dir: Path, cname: str, generation: str, name: str) -> Path:
+    return data_dir / 'bm25' / f'{cname}.{generation}.{name}'
+
+
+def packed_offsets(items: list[bytes]) -> np.ndarray:
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in items], out=offsets[1:])
+    return offsets
+
+
+def map_bm25_array(path: Path) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+def map_bm25_blob(path: Path) -> bytes | mmap.mmap:
+    with open(path, 'rb') as fptr:
+        if not os.fstat(fptr.fileno()).st_size:
+            return b''
+        return mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def save_bm25_segment(
+    data_dir: Path, cname: str, generation: str, segment: BM25Segment,
+) -> None:
+    blobs = {
+        'documents': [doc.encode('utf-8', errors='replace') for doc in segment.documents],
+        'metadatas': [msgpack.packb(meta, use_bin_type=True) for meta in segment.metadatas],
+        'ids': [chunk_id.encode() for chunk_id in segment.ids],
+    }
+    bm25 = segment.bm25
+    arrays = {
+        'indptr': bm25.indptr, 'indices': bm25.indices, 'tfs': bm25.tfs,
+        'doc_lengths': bm25.doc_lengths, 'idf': bm25.idf, 'path_ids': segment.path_ids,
+    }
+    for name, items in blobs.items():
+        arrays[name + '_offsets'] = packed_offsets(items)
+        bm25_data_path(data_dir, cname, generation, name + '.bin').write_bytes(b''.join(items))
+    for name, array in arrays.items():
+        np.save(bm25_data_path(data_dir, cname, generation, name + '.npy'), array)
+    bm25_data_path(data_dir, cname, generation, 'segment.msgpack').write_bytes(msgpack.packb(
+        {'terms': list(bm25.vocab), 'average_idf': bm25.average_idf}, use_bin_type=True))
+    segment.generation = generation
+
+
+def load_bm25_segment(data_dir: Path, cname: str, generation: str) -> BM25Segment:
+    def array(name: str) -> np.ndarray:
+        return map_bm25_array(bm25_data_path(data_dir, cname, generation, name + '.npy'))
+
+    def packed(name: str, decode) -> PackedSequence:
+        return PackedSequence(
+            map_bm25_blob(bm25_data_path(data_dir, cname, generation, name + '.bin')),
+            array(name + '_offsets'), decode)
+
+    info = msgpack.unpackb(bm25_data_path(
+        data_dir, cname, generation, 'segment.msgpack').read_bytes(), raw=False)
+    terms = info['terms']
+    bm25 = SparseBM25(
+        dict(zip(terms, range(len(terms)), strict=True)), array('indptr'),
+        array('indices'), array('tfs'), array('doc_lengths'), array('idf'),
+        info['average_idf'])
+    return BM25Segment(
+        bm25,
+        packed('documents', lambda data: data.decode('utf-8', errors='replace')),
+        packed('metadatas', lambda data: msgpack.unpackb(data, raw=False)),
+        packed('ids', lambda data: data.decode()),
+        array('path_ids'), generation)
+
+
 def save_bm25_index(data_dir: Path, cname: str, bm25_idx: BM25Index) -> None:
+    """
+    Persist the index as generation-tagged segment files loaded with mmap,
+    replacing the msgpack header atomically.
+    """
     path = bm25_path_for_collection(data_dir, cname)
     path.parent.mkdir(parents=True, exist_ok=True)
-    payload = {
-        'documents': bm25_idx.documents,
-        'metadatas': bm25_idx.metadatas,
+    generation = f'{time.time_ns():x}'
+    for suffix, segment in zip('md', bm25_idx.segments, strict=False):
+        if segment.generation is None:
+            save_bm25_segment(data_dir, cname, generation + suffix, segment)
+    np.save(bm25_data_path(data_dir, cname, generation, 'active.npy'), bm25_idx.active)
+    header = {
+        'format': 3,
+        'main': bm25_idx.main.generation,
+        'delta': bm25_idx.delta.generation if bm25_idx.delta is not None else None,
+        'active': generation,
+        'paths': bm25_idx.paths,
     }
-    path.write_bytes(msgpack.packb(payload, use_bin_type=True))
-    logger.info('saved BM25 index for %s (%d documents)', cname, len(bm25_idx.documents))
+    tmp = path.with_suffix('.tmp.' + str(os.getpid()))
+    tmp.write_bytes(msgpack.packb(header, use_bin_type=True))
+    tmp.replace(path)
+    keep = {header['main'], header['delta'], generation, 'msgpack', 'tmp'}
+    for stale in path.parent.glob(f'{cname}.*.*'):
+        if stale.name.split('.')[1] not in keep:
+            stale.unlink(missing_ok=True)
+    logger.info('saved BM25 index for %s (%d documents)', cname, bm25_idx.num_docs)
 
 
 def load_bm25_index(data_dir: Path, cname: str) -> BM25Index | None:
@@ -631,22 +2045,30 @@ def load_bm25_index(data_dir: Path, cname: str) -> BM25Index | None:
     if not path.exists():
         return None
     try:
-        payload = msgpack.unpackb(path.read_bytes(), raw=False)
-        documents = payload['documents']
-        metadatas = payload['metadatas']
-        tokenized = [doc.lower().split() for doc in documents]
-        if not tokenized:
-            tokenized = [['']]
-        bm25 = rank_bm25.BM25Okapi(tokenized)
-        return BM25Index(bm25, documents, metadatas)
+        header = msgpack.unpackb(path.read_bytes(), raw=False)
+        if header.get('format') != 3:
+            # older indexes lack chunk ids and are rebuilt from the collection
+            return None
+        main = load_bm25_segment(data_dir, cname, header['main'])
+        delta = None
+        if header['delta']:
+            delta = load_bm25_segment(data_dir, cname, header['delta'])
+        active = np.load(bm25_data_path(data_dir, cname, header['active'], 'active.npy'))
+        return BM25Index(main, delta, active, header['paths'])
     except Exception:
         logger.warning('failed to load BM25 index for %s', cname)
         return None
 
 
+def drop_bm25_index(data_dir: Path, cname: str) -> None:
+    bm25_cache.pop(cname, None)
+    bm25_path_for_collection(data_dir, cname).unlink(missing_ok=True)
+
+
 def build_bm25_from_collection(collection: chromadb.Collection) -> BM25Index:
     all_documents: list[str] = []
     all_metadatas: list[dict] = []
+    all_ids: list[str] = []
     count = collection.count()
     if count > 0:
         max_batch = collection._client.get_max_batch_size()
@@ -659,11 +2081,8 @@ def build_bm25_from_collection(collection: chromadb.Collection) -> BM25Index:
             )
             all_documents.extend(batch.get('documents', []))
             all_metadatas.extend(batch.get('metadatas', []))
-    tokenized = [doc.lower().split() for doc in all_documents]
-    if not tokenized:
-        tokenized = [['']]
-    bm25 = rank_bm25.BM25Okapi(tokenized)
-    return BM25Index(bm25, all_documents, all_metadatas)
+            all_ids.extend(batch.get('ids', []))
+    return BM25Index.from_chunks(all_documents, all_metadatas, all_ids)
 
 
 def get_bm25_for_collection(
@@ -683,12 +2102,217 @@ def get_bm25_for_collection(
     return bm25_idx
 
 
-def rebuild_bm25_for_source(
-    collection: chromadb.Collection, data_dir: Path, cname: str,
-) -> None:
-    bm25_idx = build_bm25_from_collection(collection)
-    save_bm25_index(data_dir, cname, bm25_idx)
-    bm25_cache[cname] = bm25_idx
+def rebuild_bm25_for_source(
+    collection: chromadb.Collection, data_dir: Path, cname: str,
+) -> None:
+    bm25_idx = build_bm25_from_collection(collection)
+    save_bm25_index(data_dir, cname, bm25_idx)
+    bm25_cache[cname] = bm25_idx
+
+
+def update_bm25_for_source(
+    collection: chromadb.Collection, data_dir: Path, cname: str,
+    deactivated_ids: list[str], activated_ids: list[str],
+    new_chunks: dict[str, tuple[str, dict]],
+) -> None:
+    """
+    Apply the chunk changes of a sync to the BM25 index of a collection,
+    building it from the collection if there is none.
+    """
+    bm25_idx = bm25_cache.get(cname) or load_bm25_index(data_dir, cname)
+    if bm25_idx is None:
+        rebuild_bm25_for_source(collection, data_dir, cname)
+        return
+    missing = [
+        chunk_id for chunk_id in activated_ids
+        if chunk_id not in new_chunks and bm25_idx.doc_id_for_chunk(chunk_id) is None]
+    if missing:
+        new_chunks = dict(new_chunks)
+        max_batch = collection._client.get_max_batch_size()
+        for start in range(0, len(missing), max_batch):
+            batch = collection.get(
+                ids=missing[start:start + max_batch], include=['documents', 'metadatas'])
+            for chunk_id, doc, meta in zip(
+                    batch['ids'], batch['documents'], batch['metadatas'], strict=True):
+                new_chunks[chunk_id] = (doc, {**meta, 'active': True})
+    bm25_idx = bm25_idx.updated(deactivated_ids, activated_ids, new_chunks)
+    if bm25_idx.needs_compaction():
+        logger.info('compacting BM25 index for %s', cname)
+        bm25_idx = bm25_idx.compacted()
+    save_bm25_index(data_dir, cname, bm25_idx)
+    bm25_cache[cname] = bm25_idx
+
+
+def stale_version_ids(conn: sqlite3.Connection, coll_id: int, keep_versions: int) -> list[int]:
+    """
+    Return the inactive versions of a collection's files beyond the
+    keep_versions most recent ones.
+    """
+    return [row[0] for row in conn.execute(
+        'SELECT id FROM (SELECT v.id, ROW_NUMBER() OVER '
+        '(PARTITION BY v.file_id ORDER BY v.id DESC) AS n '
+        'FROM versions v JOIN files f ON f.id = v.file_id '
+        "WHERE f.collection_id = ? AND f.path != '__manifest__' AND v.sha != f.active_sha) "
+        'WHERE n > ?', (coll_id, max(0, keep_versions)))]
+
+
+def remove_stale_versions(
+    collection: chromadb.Collection, data_dir: Path, cname: str, keep_versions: int,
+) -> tuple[int, list[str]]:
+    """
+    Delete the chunks of stale versions from the collection, then from the
+    file index.  Returns the version count and the chunk ids deleted.
+    """
+    conn = file_index_db(data_dir)
+    coll_id = file_index_collection_id(conn, cname)
+    stale = [] if coll_id is None else stale_version_ids(conn, coll_id, keep_versions)
+    if not stale:
+        return 0, []
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS stale_versions (id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM stale_versions')
+    conn.executemany('INSERT INTO stale_versions (id) VALUES (?)', ((v, ) for v in stale))
+    chunk_ids = [row[0] for row in conn.execute(
+        'SELECT DISTINCT chunk_id FROM chunks '
+        'WHERE version_id IN (SELECT id FROM stale_versions) AND chunk_id NOT IN '
+        '(SELECT c.chunk_id FROM chunks c JOIN versions v ON v.id = c.version_id '
+        'JOIN files f ON f.id = v.file_id WHERE f.collection_id = ? '
+        'AND c.version_id NOT IN (SELECT id FROM stale_versions))', (coll_id, ))]
+    if chunk_ids:
+        delete_chunks(collection, chunk_ids)
+    with file_index_transaction(data_dir) as conn:
+        conn.execute('DELETE FROM versions WHERE id IN (SELECT id FROM stale_versions)')
+        conn.execute(
+            "DELETE FROM files WHERE collection_id = ? AND active_sha = '' "
+            'AND NOT EXISTS (SELECT 1 FROM versions v WHERE v.file_id = files.id)', (coll_id, ))
+        conn.execute('DELETE FROM stale_versions')
+    return len(stale), chunk_ids
+
+
+def directory_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def probe_query_ms(collection: chromadb.Collection, embedding: list[float] | None) -> float:
+    """Return the median time of a few active-chunk queries for an embedding."""
+    if embedding is None:
+        return 0.0
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        collection.query(
+            query_embeddings=[embedding], n_results=10, where={'active': True}, include=[])
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def compact_collection(
+    collection: chromadb.Collection, data_dir: Path, cname: str, keep_versions: int,
+) -> dict:
+    """
+    Delete the chunks of stale inactive versions and update the BM25 index.
+    The caller must hold the collection's build lock.
+    """
+    conn = file_index_db(data_dir)
+    coll_id = file_index_collection_id(conn, cname)
+    if coll_id is None or not stale_version_ids(conn, coll_id, keep_versions):
+        return {'versions': 0, 'chunks': 0, 'bytes': 0, 'query_ms': (0.0, 0.0)}
+    chroma_dir = data_dir / 'chroma'
+    sample = collection.get(where={'active': True}, limit=1, include=['embeddings'])
+    embedding = sample['embeddings'][0].tolist() if len(sample['ids']) else None
+    size_before = directory_size(chroma_dir)
+    query_before = probe_query_ms(collection, embedding)
+    versions, chunk_ids = remove_stale_versions(collection, data_dir, cname, keep_versions)
+    if chunk_ids:
+        update_bm25_for_source(collection, data_dir, cname, chunk_ids, [], {})
+    return {
+        'versions': versions, 'chunks': len(chunk_ids),
+        'bytes': max(0, size_before - directory_size(chroma_dir)),
+        'query_ms': (query_before, probe_query_ms(collection, embedding)),
+    }
+
+
+def iter_prepared_files(
+    paths: list[str], chunk_size: int, chunk_overlap: int, workers: int,
+    file_shas: dict[str, str] | None = None,
+) -> Generator[tuple[str, Iterable[dict] | None], None, None]:
+    """
+    Load and chunk files in a thread pool, yielding them in input order
+    with a bounded read-ahead.
+    """
+    def prepare(fp: str) -> Iterable[dict] | None:
+        file_sha = (file_shas or {}).get(fp)
+        try:
+            streamed = stream_document_chunks(fp, chunk_size, chunk_overlap, file_sha)
+        except Exception:
+            return None
+        if streamed is not None:
+            return streamed
+        doc = load_single_file_document(fp, file_sha)
+        if doc is None:
+            return None
+        return prepare_document_chunks(doc, chunk_size, chunk_overlap)
+
+    workers = max(1, workers)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='rag-load')
+    futures: collections.deque = collections.deque()
+    try:
+        for fp in paths:
+            check_shutdown()
+            futures.append((fp, executor.submit(prepare, fp)))
+            while len(futures) > workers * 2 or (futures and futures[0][1].done()):
+                path, future = futures.popleft()
+                yield path, future.result()
+        while futures:
+            check_shutdown()
+            path, future = futures.popleft()
+            yield path, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def drain_to_single_writer(items: Iterable, write, maxsize: int) -> None:
+    """
+    Pass each item to write() on a single writer thread through a bounded
+    queue, re-raising the writer's exceptions.
+    """
+    write_queue: queue.Queue = queue.Queue(maxsize=max(1, maxsize))
+    errors: list[BaseException] = []
+
+    def writer() -> None:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            try:
+                write(item)
+            except BaseException as exc:
+                errors.append(exc)
+
+    thread = threading.Thread(target=writer, name='rag-writer', daemon=True)
+    thread.start()
+    try:
+        for item in items:
+            while True:
+                if errors:
+                    raise errors[0]
+                try:
+                    write_queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    check_shutdown()
+    finally:
+        write_queue.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
 
 
 def sync_collection(  # noqa
@@ -697,13 +2321,10 @@ def sync_collection(  # noqa
 ) -> None:
     check_embed_model_available(config.ollama_base_url, config.embed_model)
     embed_model = OllamaEmbedding(
-        model_name=config.embed_model, base_url=config.ollama_base_url)
+        model_name=config.embed_model, base_url=config.ollama_base_url,
+        embed_batch_size=max(1, config.embed_batch_size))
     chunk_size = resolve_chunk_size()
-    lock = file_index_lock(data_dir)
-    with lock:
-        index = load_file_index(data_dir, held_lock=lock)
-        coll_entry = index.setdefault(cname, {'files': {}})
-        save_file_index(data_dir, index, held_lock=lock)
+    coll_entry = load_collection_index(data_dir, cname)
     files_entry = coll_entry['files']
     indexed_paths = {fp for fp in files_entry if fp != '__manifest__'}
     current_paths = set(current_hashes.keys())
@@ -727,80 +2348,177 @@ def sync_collection(  # noqa
     if not (new_paths or deleted_paths or modified_paths or reactivate_paths):
         logger.info('collection is up to date')
         return
-    httpx_logger = logging.getLogger('httpx')
-    saved_level = httpx_logger.level
-    httpx_logger.setLevel(logging.WARNING)
-    for fp in deleted_paths:
-        logger.debug('deactivating deleted file: %s', fp)
-        for version_ids in files_entry[fp].get('versions', {}).values():
-            set_chunks_active(collection, version_ids, False)
-        files_entry[fp]['active_sha'] = ''
-    for fp in reactivate_paths:
-        new_sha = current_hashes[fp]
-        file_entry = files_entry[fp]
-        old_sha = file_entry['active_sha']
-        logger.debug('reactivating %s: %s -> %s', fp, old_sha, new_sha)
-        if old_sha and old_sha in file_entry.get('versions', {}):
-            set_chunks_active(collection, file_entry['versions'][old_sha], False)
-        set_chunks_active(collection, file_entry['versions'][new_sha], True)
-        file_entry['active_sha'] = new_sha
-    paths_to_embed = sorted(new_paths | modified_paths)
-    if paths_to_embed:
-        with tqdm.tqdm(
-            total=len(paths_to_embed), desc='Embedding files',
-            unit='file', dynamic_ncols=True,
-        ) as progress:
-            for fp in paths_to_embed:
-                check_shutdown()
-                new_sha = current_hashes[fp]
-                if fp in modified_paths:
-                    old_sha = files_entry[fp].get('active_sha', '')
-                    if old_sha and old_sha in files_entry[fp].get('versions', {}):
-                        set_chunks_active(
-                            collection, files_entry[fp]['versions'][old_sha], False)
-                doc = load_single_file_document(fp)
-                if doc is None:
-                    logger.warning('failed to load %s, skipping', fp)
-                    progress.update(1)
-                    continue
-                texts, embeddings, metadatas, ids = embed_document_chunks(
-                    doc, chunk_size, config.chunk_overlap, embed_model)
-                try:
-                    add_chunks_to_collection(collection, texts, embeddings, metadatas, ids)
-                except Exception:
-                    logger.info('Failed to add chunks for %s (%r)', fp)
-                    continue
-                file_entry = files_entry.setdefault(fp, {'active_sha': '', 'versions': {}})
-                file_entry['active_sha'] = new_sha
-                file_entry['versions'][new_sha] = ids
-                save_file_index_entry(data_dir, cname, coll_entry)
-                logger.debug('embedded %s (%d chunks)', fp, len(ids))
+    bump_collection_generation(cname)
+    sync_start = time.perf_counter()
+    bm25_deactivated: list[str] = []
+    bm25_activated: list[str] = []
+    bm25_new_chunks: dict[str, tuple[str, dict]] = {}
+    try:
+        for fp in deleted_paths:
+            logger.debug('deactivating deleted file: %s', fp)
+            for version_ids in files_entry[fp].get('versions', {}).values():
+                set_chunks_active(collection, version_ids, False)
+                bm25_deactivated.extend(version_ids)
+            files_entry[fp]['active_sha'] = ''
+        save_file_entries(data_dir, cname, {fp: files_entry[fp] for fp in deleted_paths})
+        for fp in reactivate_paths:
+            new_sha = current_hashes[fp]
+            file_entry = files_entry[fp]
+            old_sha = file_entry['active_sha']
+            logger.debug('reactivating %s: %s -> %s', fp, old_sha, new_sha)
+            if old_sha and old_sha in file_entry.get('versions', {}):
+                set_chunks_active(collection, file_entry['versions'][old_sha], False)
+                bm25_deactivated.extend(file_entry['versions'][old_sha])
+            set_chunks_active(collection, file_entry['versions'][new_sha], True)
+            bm25_activated.extend(file_entry['versions'][new_sha])
+            file_entry['active_sha'] = new_sha
+        save_file_entries(data_dir, cname, {fp: files_entry[fp] for fp in reactivate_paths})
+        paths_to_embed = sorted(new_paths | modified_paths)
+        written_ids: dict[str, list[str]] = {}
+        failed_paths: set[str] = set()
+
+        def discard_file(fp: str, final: bool) -> None:
+            partial_ids = written_ids.pop(fp, [])
+            in_use = indexed_chunk_ids(data_dir, cname, partial_ids).union(
+                *written_ids.values())
+            partial_ids = [chunk_id for chunk_id in partial_ids if chunk_id not in in_use]
+            delete_chunks(collection, partial_ids)
+            for chunk_id in partial_ids:
+                bm25_new_chunks.pop(chunk_id, None)
+            if final:
+                failed_paths.discard(fp)
                 progress.update(1)
-    httpx_logger.setLevel(saved_level)
-    update_manifest(
-        collection,
-        [fp for fp in current_hashes if fp != '__manifest__'],
-        chunk_size, config.chunk_overlap, embed_model, coll_entry,
-    )
-    save_file_index(data_dir, index, coll_entry)
-    rebuild_bm25_for_source(collection, data_dir, cname)
-    logger.info('sync complete')
+            else:
+                failed_paths.add(fp)
+
+        def write_embedded_file(item: tuple[str, tuple | None, bool]) -> None:
+            check_shutdown()
+            fp, embedded, final = item
+            if fp in failed_paths:
+                discard_file(fp, final)
+                return
+            new_sha = current_hashes[fp]
+            if fp in modified_paths and fp not in written_ids:
+                old_sha = files_entry[fp].get('active_sha', '')
+                if old_sha and old_sha in files_entry[fp].get('versions', {}):
+                    set_chunks_active(
+                        collection, files_entry[fp]['versions'][old_sha], False)
+                    bm25_deactivated.extend(files_entry[fp]['versions'][old_sha])
+            if embedded is None:
+                logger.warning('failed to load %s, skipping', fp)
+                discard_file(fp, final)
+                return
+            texts, embeddings, metadatas, ids = embedded
+            try:
+                add_chunks_to_collection(collection, texts, embeddings, metadatas, ids)
+            except Exception:
+                logger.info('Failed to add chunks for %s', fp)
+                discard_file(fp, final)
+                return
+            bm25_new_chunks.update(zip(ids, zip(texts, metadatas, strict=True), strict=True))
+            ids = written_ids.setdefault(fp, [])
+            ids.extend(embedded[3])
+            if not final:
+                return
+            del written_ids[fp]
+            file_entry = files_entry.setdefault(fp, {'active_sha': '', 'versions': {}})
+            file_entry['active_sha'] = new_sha
+            file_entry['versions'][new_sha] = ids
+            save_file_entries(data_dir, cname, {fp: file_entry})
+            bm25_activated.extend(ids)
+            with cache_lock:
+                cache_stats['sync_files_embedded'] += 1
+                cache_stats['sync_chunks_added'] += len(ids)
+            logger.debug('embedded %s (%d chunks)', fp, len(ids))
+            progress.update(1)
+
+        if paths_to_embed:
+            with timed_stage('sync_embed'), tqdm.tqdm(
+                total=len(paths_to_embed), desc='Embedding files',
+                unit='file', dynamic_ncols=True,
+            ) as progress:
+                drain_to_single_writer(
+                    embed_files_batched(
+                        iter_prepared_files(
+                            paths_to_embed, chunk_size, config.chunk_overlap,
+                            config.load_workers, current_hashes),
+                        embed_model, config.embed_batch_size, config.embed_concurrency),
+                    write_embedded_file, maxsize=2 * max(1, config.embed_concurrency))
+        bm25_deactivated.extend(
+            chunk_id
+            for version_ids in files_entry.get('__manifest__', {}).get('versions', {}).values()
+            for chunk_id in version_ids)
+        with timed_stage('sync_manifest'):
+            update_manifest(
+                collection,
+                [fp for fp in current_hashes if fp != '__manifest__'],
+                chunk_size, config.chunk_overlap, embed_model, coll_entry,
+            )
+        save_file_entries(data_dir, cname, {'__manifest__': files_entry['__manifest__']})
+        for version_ids in files_entry['__manifest__']['versions'].values():
+            bm25_activated.extend(version_ids)
+        logger.info('sync complete')
+    finally:
+        apply_sync_to_bm25(
+            collection, data_dir, cname, bm25_deactivated, bm25_activated, bm25_new_chunks)
+        record_stage('sync', time.perf_counter() - sync_start)
+        bump_collection_generation(cname)
+
+
+def apply_sync_to_bm25(
+    collection: chromadb.Collection, data_dir: Path, cname: str,
+    deactivated_ids: list[str], activated_ids: list[str],
+    new_chunks: dict[str, tuple[str, dict]],
+) -> None:
+    """
+    Apply the changes a sync saved to the BM25 index, dropping the index
+    so it is rebuilt if that fails.
+    """
+    try:
+        with timed_stage('sync_bm25'):
+            update_bm25_for_source(
+                collection, data_dir, cname, deactivated_ids, activated_ids, new_chunks)
+    except Exception:
+        logger.exception('updating the BM25 index of %s failed; it will be rebuilt', cname)
+        drop_bm25_index(data_dir, cname)
+
+
+def chroma_client_for_data_dir(data_dir: Path) -> chromadb.ClientAPI:
+    chroma_dir = str(data_dir / 'chroma')
+    with cache_lock:
+        if chroma_dir not in chroma_clients:
+            os.makedirs(chroma_dir, exist_ok=True)
+            chroma_clients[chroma_dir] = chromadb.PersistentClient(path=chroma_dir)
+        return chroma_clients[chroma_dir]
+
+
+def get_collection_handle(data_dir: Path, cname: str) -> chromadb.Collection:
+    """
+    Return a cached handle to an existing collection.  This raises if the
+    collection does not exist.
+    """
+    collection = collection_handles.get(cname)
+    if collection is None:
+        collection = chroma_client_for_data_dir(data_dir).get_collection(cname)
+        collection_handles[cname] = collection
+    return collection
 
 
 def build_collection_for_source(src: SourceConfig) -> chromadb.Collection:
     data_dir = Path(config.data_dir)
-    chroma_dir = data_dir / 'chroma'
-    chroma_dir.mkdir(parents=True, exist_ok=True)
     cname = collection_name_for_source(
         config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
-    chroma_client = chromadb.PersistentClient(path=str(chroma_dir))
+    chroma_client = chroma_client_for_data_dir(data_dir)
+    collection_handles.pop(cname, None)
     try:
         chroma_client.delete_collection(cname)
     except Exception:
         pass
-    collection = chroma_client.create_collection(cname)
+    collection = collection_handles[cname] = chroma_client.create_collection(cname)
     save_file_index_entry(data_dir, cname, {'files': {}})
+    drop_bm25_index(data_dir, cname)
     sync_collection(collection, data_dir, cname, current_file_hashes_for_source(src))
+    return collection
 
 
 def source_unavailable(src: SourceConfig) -> bool:
@@ -808,30 +2526,73 @@ def source_unavailable(src: SourceConfig) -> bool:
         return not Path(src.source_path).is_file()
     if is_git_source(src):
         try:
-            git.Repo(src.source_path)
-            return False
+            with git_repo_for_source(src.source_path) as repo:
+                if repo.head.is_valid():
+                    return False
         except Exception:
-            return True
+            pass
+        with build_locks_mutex:
+            git_repos.pop(src.source_path, None)
+        return True
     source = Path(src.source_path)
     return not source.exists() or not any(source.iterdir())
 
 
-def get_collection_for_source(src: SourceConfig) -> chromadb.Collection | None:
+def build_lock_for_collection(cname: str) -> threading.Lock:
+    with build_locks_mutex:
+        if cname not in build_locks:
+            build_locks[cname] = threading.Lock()
+        return build_locks[cname]
+
+
+def source_is_fresh(src: SourceConfig, cname: str) -> bool:
+    """
+    Report if a source's last full check can be trusted, starting a
+    background check once it is older than the freshness interval.
+    """
+    interval = config.freshness_interval
+    state = source_freshness.get(cname)
+    if interval <= 0 or state is None:
+        return False
+    if time.monotonic() - state[1] < interval or cname in freshness_pending:
+        return True
+    if source_snapshot(src) != state[0]:
+        return False
+    with build_locks_mutex:
+        if cname in freshness_pending:
+            return True
+        freshness_pending.add(cname)
+    threading.Thread(
+        target=refresh_collection_for_source, args=(src, cname), daemon=True).start()
+    return True
+
+
+def refresh_collection_for_source(src: SourceConfig, cname: str) -> None:
+    try:
+        get_collection_for_source(src, refresh=True)
+    except Exception:
+        logger.exception('background check of %s failed', src.source_path)
+    finally:
+        with build_locks_mutex:
+            freshness_pending.discard(cname)
+
+
+def get_collection_for_source(
+    src: SourceConfig, refresh: bool = False,
+) -> chromadb.Collection | None:
     data_dir = Path(config.data_dir)
-    chroma_dir = data_dir / 'chroma'
-    chroma_dir.mkdir(parents=True, exist_ok=True)
     cname = collection_name_for_source(
         config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
-    chroma_client = chromadb.PersistentClient(path=str(chroma_dir))
+    if not refresh and source_is_fresh(src, cname):
+        try:
+            return get_collection_handle(data_dir, cname)
+        except Exception:
+            source_freshness.pop(cname, None)
     unavailable = source_unavailable(src)
-    with build_locks_mutex:
-        if cname not in build_locks:
-            build_locks[cname] = threading.Lock()
-        lock = build_locks[cname]
-    with lock:
+    with build_lock_for_collection(cname):
         if unavailable:
             try:
-                collection = chroma_client.get_collection(cname)
+                collection = get_collection_handle(data_dir, cname)
                 if collection.count() > 0:
                     logger.info(
                         'source %s unavailable; reusing existing embeddings '
@@ -841,25 +2602,212 @@ def get_collection_for_source(src: SourceConfig) -> chromadb.Collection | None:
             except Exception:
                 pass
             return None
-        hashes = current_file_hashes_for_source(src)
+        snapshot = source_snapshot(src)
+        commit = ''
+        if is_git_source(src):
+            hashes, commit = git_file_hashes_for_source(src, data_dir, cname)
+        else:
+            hashes = current_file_hashes_for_source(src)
         try:
-            collection = chroma_client.get_collection(cname)
+            collection = get_collection_handle(data_dir, cname)
         except Exception:
-            return build_collection_for_source(src)
-        index = load_file_index(data_dir)
-        indexed_hashes = {
-            fp: data['active_sha']
-            for fp, data in index.get(cname, {}).get('files', {}).items()
-            if fp != '__manifest__' and data.get('active_sha')
-        }
-        if hashes != indexed_hashes:
-            sync_collection(collection, data_dir, cname, hashes)
+            collection = build_collection_for_source(src)
+        else:
+            if hashes != load_active_hashes(data_dir, cname):
+                sync_collection(collection, data_dir, cname, hashes)
+        if commit and load_active_hashes(data_dir, cname) == hashes:
+            save_indexed_commit(data_dir, cname, commit, git_filter_fingerprint(src))
+        elif commit:
+            logger.info('some files of %s were not indexed; keeping the indexed commit',
+                        src.source_path)
+        source_freshness[cname] = (snapshot, time.monotonic())
         return collection
-    bm25_path = bm25_path_for_collection(data_dir, cname)
-    if not bm25_path.exists() and collection.count() > 0:
-        logger.info('BM25 index missing for %s, building from existing collection', cname)
-        rebuild_bm25_for_source(collection, data_dir, cname)
-    return collection
+
+
+def sync_source_paths(src: SourceConfig, paths: set[str] | None) -> None:
+    """
+    Sync just the given paths of a directory source against its index.  Git
+    and single-file sources, and a paths value of None, get a full check.
+    """
+    if paths is None or src.is_file or is_git_source(src):
+        get_collection_for_source(src, refresh=True)
+        return
+    data_dir = Path(config.data_dir)
+    cname = collection_name_for_source(
+        config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
+    try:
+        collection = get_collection_handle(data_dir, cname)
+    except Exception:
+        get_collection_for_source(src, refresh=True)
+        return
+    base = Path(src.source_path)
+    suffixes = [e.strip() for e in src.dir_suffixes.split(',')]
+    spec = make_pathspec(src.exclude)
+    with build_lock_for_collection(cname):
+        snapshot = source_snapshot(src)
+        indexed = load_active_hashes(data_dir, cname)
+        hashes = dict(indexed)
+        for path in paths:
+            p = Path(path)
+            fp = os.path.join(src.source_path, p.relative_to(base).as_posix())
+            try:
+                if p.is_file() and path_included(base, p, suffixes, spec):
+                    with open(p, 'rb') as fptr:
+                        hashes[fp] = hashlib.file_digest(fptr, 'sha256').hexdigest()
+                    continue
+            except OSError:
+                pass
+            hashes.pop(fp, None)
+        if hashes != indexed:
+            logger.info('watch: syncing %d changed path%s in %s', len(paths),
+                        's' if len(paths) != 1 else '', src.source_path)
+            sync_collection(collection, data_dir, cname, hashes)
+        if cname in source_freshness:
+            source_freshness[cname] = (snapshot, source_freshness[cname][1])
+
+
+class SourceWatchHandler(watchdog.events.FileSystemEventHandler):
+    """Pass filesystem events for one source to a SourceWatcher."""
+
+    def __init__(self, watcher: 'SourceWatcher', src: SourceConfig, root: str):
+        self.watcher = watcher
+        self.src = src
+        self.root = root
+
+    def on_any_event(self, event: watchdog.events.FileSystemEvent) -> None:
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+        paths = [os.fsdecode(p) for p in (event.src_path, event.dest_path) if p]
+        if self.src.is_file:
+            if self.src.source_path in paths:
+                self.watcher.add(self.src, None)
+        elif is_git_source(self.src):
+            for path in paths:
+                rel = os.path.relpath(path, self.root).removesuffix('.lock')
+                if rel in ('HEAD', 'index', 'packed-refs') or rel.startswith('refs' + os.sep):
+                    self.watcher.add(self.src, None)
+                    return
+        elif event.is_directory:
+            if event.event_type not in ('modified', 'closed'):
+                self.watcher.add(self.src, None)
+        else:
+            self.watcher.add(self.src, paths)
+
+
+class SourceWatcher:
+    """
+    Watch the configured sources and sync what changed once no events
+    have arrived for the debounce interval.
+    """
+
+    def __init__(self, sources: list[SourceConfig], debounce: float):
+        self.sources = sources
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.changes: dict[int, set[str] | None] = {}
+        self.last_event = 0.0
+        self.observer = watchdog.observers.Observer()
+        for src in sources:
+            if src.is_file:
+                root, recursive = os.path.dirname(src.source_path), False
+            elif is_git_source(src):
+                root, recursive = git_dir_for_source(src.source_path), True
+            else:
+                root = os.path.join(src.source_path, src.source_sub_path)
+                recursive = True
+            if not os.path.isdir(root):
+                logger.warning('cannot watch %s; it is not available', src.source_path)
+                continue
+            self.observer.schedule(SourceWatchHandler(self, src, root), root, recursive=recursive)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def add(self, src: SourceConfig, paths: list[str] | None) -> None:
+        key = self.sources.index(src)
+        with self.lock:
+            if paths is None or self.changes.get(key, set()) is None:
+                self.changes[key] = None
+            else:
+                self.changes.setdefault(key, set()).update(paths)
+            self.last_event = time.monotonic()
+
+    def start(self) -> None:
+        self.observer.start()
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.observer.stop()
+        self.observer.join()
+
+    def run(self) -> None:
+        while not shutdown_event.wait(min(self.debounce, 0.5)):
+            with self.lock:
+                if not self.changes or time.monotonic() - self.last_event < self.debounce:
+                    continue
+                changes, self.changes = self.changes, {}
+            for key, paths in changes.items():
+                try:
+                    sync_source_paths(self.sources[key], paths)
+                except Exception:
+                    logger.exception('watch: failed to sync %s', self.sources[key].source_path)
+
+
+def preload_embed_model() -> None:
+    try:
+        get_http_client().post(
+            f'{config.ollama_base_url}/api/embed',
+            json={'model': config.embed_model, 'input': 'ping'}, timeout=None,
+        ).raise_for_status()
+    except Exception as exc:
+        logger.warning('could not preload embedding model %s: %s', config.embed_model, exc)
+
+
+def warm_up() -> None:
+    """
+    Sync all sources in parallel, load their BM25 and neighbor indexes, and
+    preload the embedding model, then report the server as ready.
+    """
+    start = time.perf_counter()
+    data_dir = Path(config.data_dir)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(source_configs) + 1) as executor:
+        executor.submit(preload_embed_model)
+        futures = {executor.submit(get_collection_for_source, src): src for src in source_configs}
+        for future, src in futures.items():
+            try:
+                collection = future.result()
+                if collection is not None and collection.count() > 0:
+                    bm25_idx = get_bm25_for_collection(collection, data_dir, collection.name)
+                    bm25_idx.load_file_offsets()
+            except Exception:
+                logger.exception('warm-up of %s failed', src.source_path)
+    ready_event.set()
+    logger.info('warm-up complete in %.1f s', time.perf_counter() - start)
+
+
+def compact_all_collections(keep_versions: int) -> None:
+    data_dir = Path(config.data_dir)
+    for src in source_configs:
+        cname = collection_name_for_source(
+            config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
+        with build_lock_for_collection(cname):
+            try:
+                collection = get_collection_handle(data_dir, cname)
+            except Exception:
+                continue
+            stats = compact_collection(collection, data_dir, cname, keep_versions)
+        if stats['chunks']:
+            logger.info(
+                'compacted %s: removed %d versions and %d chunks, Chroma directory '
+                '%d bytes smaller, probe query %.1f ms -> %.1f ms', src.source_path,
+                stats['versions'], stats['chunks'], stats['bytes'], *stats['query_ms'])
+
+
+def run_compaction(interval: float, keep_versions: int) -> None:
+    while not shutdown_event.wait(interval):
+        try:
+            compact_all_collections(keep_versions)
+        except Exception:
+            logger.exception('compaction failed')
 
 
 def get_all_collections() -> list[chromadb.Collection]:
@@ -946,19 +2894,13 @@ def bm25_search(
 ) -> list[tuple[str, dict, float]]:
     if not bm25_idx.documents:
         return []
-    tokenized_query = query.lower().split()
-    scores = bm25_idx.bm25.get_scores(tokenized_query)
-    indexed = list(zip(range(len(bm25_idx.documents)), scores, strict=True))
-    if path_filter:
-        indexed = [
-            (i, s) for i, s in indexed
-            if bm25_idx.metadatas[i].get('file_path') == path_filter
-        ]
-    indexed.sort(key=lambda x: x[1], reverse=True)
+    doc_ids = bm25_idx.doc_ids_for_path(path_filter) if path_filter else None
+    if doc_ids is not None and not len(doc_ids):
+        return []
+    ids, scores = bm25_idx.top_n(tokenize_bm25(query), top_n, doc_ids)
     return [
-        (bm25_idx.documents[i], bm25_idx.metadatas[i], score)
-        for i, score in indexed[:top_n]
-        if score > 0
+        (bm25_idx.documents[i], bm25_idx.metadatas[i], float(score))
+        for i, score in zip(ids.tolist(), scores.tolist(), strict=True)
     ]
 
 
@@ -985,14 +2927,51 @@ def reciprocal_rank_fusion(
     ]
 
 
+def file_neighbor_candidates(
+    file_path: str, collections: list[chromadb.Collection],
+    bm25_indexes: dict[str, BM25Index],
+) -> list[tuple[np.ndarray, np.ndarray, Callable]]:
+    """
+    Return, for each collection holding a file, the offsets of its active
+    chunks and a function that returns the chunk at a position.
+    """
+    candidates = []
+    for collection in collections:
+        bm25_idx = bm25_indexes.get(collection.name)
+        if bm25_idx is not None:
+            doc_ids, byte_offsets, line_starts = bm25_idx.file_chunk_offsets(file_path)
+            if len(doc_ids):
+                candidates.append((
+                    byte_offsets, line_starts,
+                    lambda pos, idx=bm25_idx, ids=doc_ids: (
+                        idx.documents[int(ids[pos])], idx.metadatas[int(ids[pos])])))
+            continue
+        try:
+            results = collection.get(
+                where={'$and': [{'active': True}, {'file_path': {'$eq': file_path}}]},
+                include=['documents', 'metadatas'],
+            )
+        except Exception:
+            continue
+        docs, metas = results.get('documents', []), results.get('metadatas', [])
+        if metas:
+            candidates.append((
+                np.asarray([m.get('byte_offset', 0) for m in metas], dtype=np.int64),
+                np.asarray([m.get('line_start', 0) for m in metas], dtype=np.int64),
+                lambda pos, docs=docs, metas=metas: (docs[pos], metas[pos])))
+    return candidates
+
+
 def expand_context(
     fused: list[tuple[str, dict]],
     collections: list[chromadb.Collection],
     expansion_lines: int = 20,
     expansion_bytes: int = 4096,
+    bm25_indexes: dict[str, BM25Index] | None = None,
 ) -> list[tuple[str, dict]]:
     expanded: list[tuple[str, dict]] = []
     seen: set[str] = set()
+    file_candidates: dict[str, list] = {}
     for text, meta in fused:
         file_path = meta.get('file_path', '')
         chunk_key = f"{file_path}:{meta.get('byte_offset', 0)}"
@@ -1002,35 +2981,170 @@ def expand_context(
         expanded.append((text, meta))
         if not file_path or file_path == '__manifest__':
             continue
-        for collection in collections:
-            try:
-                results = collection.get(
-                    where={'$and': [{'active': True}, {'file_path': {'$eq': file_path}}]},
-                    include=['documents', 'metadatas'],
-                )
-            except Exception:
-                continue
-            for doc, m in zip(results.get('documents', []), results.get(
-                    'metadatas', []), strict=True):
-                neighbor_key = f"{file_path}:{m.get('byte_offset', 0)}"
-                line_distance = abs(m.get('line_start', 0) - meta.get('line_start', 0))
-                byte_distance = abs(m.get('byte_offset', 0) - meta.get('byte_offset', 0))
-                if (neighbor_key not in seen and
-                        line_distance <= expansion_lines and
-                        byte_distance < expansion_bytes):
+        if file_path not in file_candidates:
+            file_candidates[file_path] = file_neighbor_candidates(
+                file_path, collections, bm25_indexes or {})
+        for byte_offsets, line_starts, chunk_at in file_candidates[file_path]:
+            near = np.flatnonzero(
+                (np.abs(line_starts - meta.get('line_start', 0)) <= expansion_lines) &
+                (np.abs(byte_offsets - meta.get('byte_offset', 0)) < expansion_bytes))
+            for pos in near.tolist():
+                neighbor_key = f'{file_path}:{int(byte_offsets[pos])}'
+                if neighbor_key not in seen:
                     seen.add(neighbor_key)
-                    expanded.append((doc, m))
+                    expanded.append(chunk_at(pos))
     return expanded
 
 
-def retrieve_context(  # noqa
+def embed_query(query: str) -> list[float]:
+    """Embed a query, reusing the embedding of an identical recent query."""
+    global query_embedding_cache
+
+    key = (config.embed_model, query)
+    with cache_lock:
+        if query_embedding_cache is None and config.query_cache_size > 0:
+            query_embedding_cache = cachetools.TTLCache(
+                maxsize=config.query_cache_size, ttl=config.query_cache_ttl)
+        embedding = query_embedding_cache.get(key) if query_embedding_cache is not None else None
+        cache_stats['query_embedding_hits' if embedding else 'query_embedding_misses'] += 1
+    if embedding:
+        return embedding
+    embed_model = OllamaEmbedding(
+        model_name=config.embed_model, base_url=config.ollama_base_url)
+    embedding = embed_model.get_text_embedding(query)
+    with cache_lock:
+        if query_embedding_cache is not None:
+            query_embedding_cache[key] = embedding
+    return embedding
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """
+    Add the duration of a stage to its histogram for /metrics, and to the
+    timings of the current request when it collects them.
+    """
+    with cache_lock:
+        metric = stage_metrics.get(stage)
+        if metric is None:
+            metric = stage_metrics[stage] = {
+                'buckets': [0] * len(STAGE_BUCKETS), 'count': 0, 'sum': 0.0}
+        idx = bisect.bisect_left(STAGE_BUCKETS, seconds)
+        if idx < len(STAGE_BUCKETS):
+            metric['buckets'][idx] += 1
+        metric['count'] += 1
+        metric['sum'] += seconds
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def render_metrics() -> str:
+    """Return the counters and stage histograms in Prometheus text format."""
+    lines = []
+    with cache_lock:
+        for name, value in sorted(cache_stats.items()):
+            lines += [f'# TYPE ollama_rag_{name}_total counter', f'ollama_rag_{name}_total {value}']
+        lines += [
+            '# HELP ollama_rag_stage_seconds Duration of retrieval, sync and chat stages.',
+            '# TYPE ollama_rag_stage_seconds histogram']
+        for stage, metric in sorted(stage_metrics.items()):
+            cumulative = 0
+            for bound, count in zip(STAGE_BUCKETS, metric['buckets'], strict=True):
+                cumulative += count
+                lines.append(
+                    f'ollama_rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines += [
+                f'ollama_rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {metric["count"]}',
+                f'ollama_rag_stage_seconds_sum{{stage="{stage}"}} {metric["sum"]:.6f}',
+                f'ollama_rag_stage_seconds_count{{stage="{stage}"}} {metric["count"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
+
+
+def bump_collection_generation(cname: str) -> None:
+    """Invalidate cached retrievals that include a collection."""
+    with cache_lock:
+        collection_generations[cname] += 1
+
+
+def retrieve_context(
     query: str, *, path_filter: str | None = None,
     path_pattern: str | None = None, top_k_override: int | None = None,
 ) -> str:
-    collections = get_all_collections()
+    """
+    Return formatted context for a query, cached until a sync changes one
+    of the collections searched.
+    """
+    global retrieval_cache
+
+    with timed_stage('source_check'):
+        collections = get_all_collections()
     if not collections:
         logger.info('no collections available, no context to retrieve')
         return ''
+    with cache_lock:
+        key = (
+            query, path_filter, path_pattern, top_k_override, config.top_k,
+            tuple((c.name, collection_generations[c.name]) for c in collections))
+        if retrieval_cache is None and config.retrieval_cache_size > 0:
+            retrieval_cache = cachetools.TTLCache(
+                maxsize=config.retrieval_cache_size, ttl=config.query_cache_ttl)
+        context = retrieval_cache.get(key) if retrieval_cache is not None else None
+        cache_stats['retrieval_hits' if context is not None else 'retrieval_misses'] += 1
+    if context is not None:
+        return context
+    with timed_stage('search'):
+        context = search_collections(
+            collections, query, path_filter=path_filter,
+            path_pattern=path_pattern, top_k_override=top_k_override)
+    with cache_lock:
+        if retrieval_cache is not None:
+            retrieval_cache[key] = context
+    return context
+
+
+def timed_semantic_search(
+    collection: chromadb.Collection, query_embedding: list[float], n: int,
+    where_filter: dict,
+) -> tuple[dict, float]:
+    start = time.perf_counter()
+    if n == 0:
+        return {}, 0.0
+    results = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=n,
+        where=where_filter,
+        include=['documents', 'distances', 'metadatas'],
+    )
+    return results, time.perf_counter() - start
+
+
+def timed_bm25_search(
+    collection: chromadb.Collection, data_dir: Path, query: str, top_n: int,
+    path_filter: str | None,
+) -> tuple[BM25Index, list[tuple[str, dict, float]], float]:
+    start = time.perf_counter()
+    bm25_idx = get_bm25_for_collection(collection, data_dir, collection.name)
+    results = bm25_search(bm25_idx, query, top_n, path_filter)
+    return bm25_idx, results, time.perf_counter() - start
+
+
+def search_collections(  # noqa
+    collections: list[chromadb.Collection], query: str, *, path_filter: str | None = None,
+    path_pattern: str | None = None, top_k_override: int | None = None,
+) -> str:
     pattern_matched_paths: list[str] | None = None
     if path_pattern is not None:
         all_active = get_active_file_paths()
@@ -1041,8 +3155,6 @@ def retrieve_context(  # noqa
                 if pattern_matched_paths is None:
                     pattern_matched_paths = []
                 pattern_matched_paths.append(abs_path)
-    embed_model = OllamaEmbedding(
-        model_name=config.embed_model, base_url=config.ollama_base_url)
     check_shutdown()
     max_query_len = resolve_chunk_size(for_query=True)
     if len(query) > max_query_len:
@@ -1050,9 +3162,9 @@ def retrieve_context(  # noqa
                     len(query), max_query_len)
         half = (max_query_len - 5) // 2
         query = query[:half] + '\n...\n' + query[-half:]
-    query_embedding = embed_model.get_text_embedding(query)
     base_k = top_k_override if top_k_override is not None else config.top_k
-    total_count = sum(c.count() for c in collections)
+    counts = [c.count() for c in collections]
+    total_count = sum(counts)
     min_top_k = min(max(1, base_k // 2), total_count)
     max_top_k = min(base_k * 2, total_count)
     active_condition: dict = {'active': True}
@@ -1067,25 +3179,45 @@ def retrieve_context(  # noqa
         }
     else:
         where_filter = active_condition
-    all_documents: list[str] = []
-    all_distances: list[float] = []
-    all_metadatas: list[dict] = []
     data_dir = Path(config.data_dir)
-    for collection in collections:
-        n = min(max_top_k, collection.count())
-        if n == 0:
-            continue
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n,
-            where=where_filter,
-            include=['documents', 'distances', 'metadatas'],
-        )
-        all_documents.extend(results.get('documents', [[]])[0])
-        all_distances.extend(results.get('distances', [[]])[0])
-        all_metadatas.extend(results.get('metadatas', [[]])[0])
+    source_paths = {
+        collection_name_for_source(
+            config.embed_model, config.chunk_size, config.chunk_overlap,
+            src.source_path): src.source_path
+        for src in source_configs}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, 2 * len(collections))) as executor:
+        bm25_futures = [
+            executor.submit(timed_bm25_search, collection, data_dir, query, max_top_k, path_filter)
+            for collection in collections]
+        with timed_stage('embed_query'):
+            query_embedding = embed_query(query)
+        semantic_futures = [
+            executor.submit(timed_semantic_search, collection, query_embedding,
+                            min(max_top_k, count), where_filter)
+            for collection, count in zip(collections, counts, strict=True)]
+        all_documents: list[str] = []
+        all_distances: list[float] = []
+        all_metadatas: list[dict] = []
+        all_bm25_results: list[tuple[str, dict, float]] = []
+        bm25_indexes: dict[str, BM25Index] = {}
+        for collection, semantic_future, bm25_future in zip(
+                collections, semantic_futures, bm25_futures, strict=True):
+            results, semantic_time = semantic_future.result()
+            bm25_idx, bm25_results, bm25_time = bm25_future.result()
+            logger.info('source %s: semantic %.1f ms, bm25 %.1f ms',
+                        source_paths.get(collection.name, collection.name),
+                        semantic_time * 1000, bm25_time * 1000)
+            record_stage('semantic', semantic_time)
+            record_stage('bm25', bm25_time)
+            all_documents.extend(results.get('documents', [[]])[0])
+            all_distances.extend(results.get('distances', [[]])[0])
+            all_metadatas.extend(results.get('metadatas', [[]])[0])
+            bm25_indexes[collection.name] = bm25_idx
+            all_bm25_results.extend(bm25_results)
     if not all_documents:
         return ''
+    fuse_start = time.perf_counter()
     semantic_ranked = sorted(zip(all_distances, all_documents, all_metadatas, strict=True),
                              key=lambda x: x[0])
     semantic_distances = [dist for dist, _, _ in semantic_ranked]
@@ -1094,17 +3226,6 @@ def retrieve_context(  # noqa
         (doc, meta) for _, doc, meta in semantic_ranked[:semantic_chosen_k]
     ]
     logger.info('semantic chosen: %d', semantic_chosen_k)
-
-    all_bm25_results: list[tuple[str, dict, float]] = []
-    for src in source_configs:
-        cname = collection_name_for_source(
-            config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
-        for collection in collections:
-            if collection.name == cname:
-                bm25_idx = get_bm25_for_collection(collection, data_dir, cname)
-                all_bm25_results.extend(
-                    bm25_search(bm25_idx, query, max_top_k, path_filter))
-                break
     all_bm25_results.sort(key=lambda x: x[2], reverse=True)
     bm25_scores = [s for _, _, s in all_bm25_results]
     if bm25_scores:
@@ -1115,27 +3236,26 @@ def retrieve_context(  # noqa
     bm25_top = all_bm25_results[:bm25_chosen_k]
     logger.info('bm25 chosen: %d', bm25_chosen_k)
     fused = reciprocal_rank_fusion(semantic_top, bm25_top, max_top_k)
+    record_stage('rrf', time.perf_counter() - fuse_start)
     logger.info('RRF fused: %d', len(fused))
     expansion_lines = max(20, config.chunk_size // 32) if config.chunk_size > 0 else 20
-    expanded = expand_context(fused, collections, expansion_lines, resolve_chunk_size())
+    with timed_stage('expand'):
+        expanded = expand_context(
+            fused, collections, expansion_lines, resolve_chunk_size(), bm25_indexes)
     logger.info('expanded context chunks: %d (from %d fused)', len(expanded), len(fused))
     final_documents = [text for text, _ in expanded]
     final_metadatas = [meta for _, meta in expanded]
-    return format_chunks(final_documents, final_metadatas)
+    with timed_stage('format'):
+        return format_chunks(final_documents, final_metadatas)
 
 
 def get_active_file_paths() -> list[str]:
     data_dir = Path(config.data_dir)
-    index = load_file_index(data_dir)
     all_paths: set[str] = set()
     for src in source_configs:
         cname = collection_name_for_source(
             config.embed_model, config.chunk_size, config.chunk_overlap, src.source_path)
-        files = index.get(cname, {}).get('files', {})
-        all_paths.update(
-            fp for fp, entry in files.items()
-            if fp != '__manifest__' and entry.get('active_sha')
-        )
+        all_paths.update(load_active_hashes(data_dir, cname))
     return sorted(all_paths)
 
 
@@ -1263,6 +3383,12 @@ def inject_context(body: dict, context: str) -> dict:
     return body
 
 
+def tee_prefix(prefix: bytearray, chunk: bytes) -> None:
+    """Keep up to CHAT_LOG_PREFIX_BYTES of a proxied body for the chat log."""
+    if len(prefix) < CHAT_LOG_PREFIX_BYTES:
+        prefix.extend(chunk[:CHAT_LOG_PREFIX_BYTES - len(prefix)])
+
+
 def extract_rag_params(body: dict) -> dict:
     rag_params: dict = {}
     for key in list(body.keys()):
@@ -1283,6 +3409,24 @@ def apply_rag_params(
     return top_k_override, path_pattern
 
 
+@app.get('/rag/ready')
+async def rag_ready():
+    if not ready_event.is_set():
+        return fastapi.responses.JSONResponse({'ready': False}, status_code=503)
+    return {'ready': True}
+
+
+@app.get('/rag/stats')
+async def rag_stats():
+    return dict(cache_stats)
+
+
+@app.get('/metrics')
+async def metrics():
+    return fastapi.responses.PlainTextResponse(
+        render_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.post('/v1/chat/completions')
 async def chat_completions(request: fastapi.Request):  # noqa
     body = await request.json()
@@ -1294,10 +3438,17 @@ async def chat_completions(request: fastapi.Request):  # noqa
     if rag_params:
         logger.info('rag params: %s', rag_params)
     top_k_override, path_pattern = apply_rag_params(rag_params)
+    with cache_lock:
+        cache_stats['chat_requests'] += 1
+    timings: dict[str, float] = {}
+    if config.server_timing:
+        request_timings.set(timings)
     if query and source_configs:
         try:
-            context = await asyncio.to_thread(
-                retrieve_context, query, path_pattern=path_pattern, top_k_override=top_k_override)
+            with timed_stage('retrieve'):
+                context = await asyncio.to_thread(
+                    retrieve_context, query, path_pattern=path_pattern,
+                    top_k_override=top_k_override)
             logger.info('context length: %d', len(context))
             if len(context):
                 logger.debug('context:\n%s', context)
@@ -1308,17 +3459,23 @@ async def chat_completions(request: fastapi.Request):  # noqa
     log_chat = chat_logger.getEffectiveLevel() <= logging.INFO
     if log_chat:
         chat_logger.info('openai request: %s', json.dumps(body))
+    timing_headers = {'Server-Timing': server_timing_header(timings)} if timings else {}
     if stream:
         async def generate():
             response_chunks = []
             completed = False
+            start = time.perf_counter()
+            first_chunk = True
             try:
-                async with httpx.AsyncClient(timeout=None) as client, client.stream(
+                async with get_async_http_client().stream(
                     'POST', f'{ollama_base_url}/v1/chat/completions',
                     json=body, headers={'Content-Type': 'application/json'},
                 ) as response:
                     logger.debug('stream status: %d', response.status_code)
                     async for chunk in response.aiter_bytes():
+                        if first_chunk:
+                            record_stage('upstream_first_byte', time.perf_counter() - start)
+                            first_chunk = False
                         try:
                             if log_chat:
                                 response_chunks.append(json.loads(chunk.decode(
@@ -1329,24 +3486,24 @@ async def chat_completions(request: fastapi.Request):  # noqa
                         yield chunk
                 completed = True
             finally:
+                record_stage('upstream', time.perf_counter() - start)
                 if log_chat:
                     chat_logger.info(
                         '%sstreaming openai response: %s', '' if completed else 'partial ',
                         json.dumps({'content': ''.join(response_chunks)}))
-        return fastapi.responses.StreamingResponse(generate(), media_type='text/event-stream')
+        return fastapi.responses.StreamingResponse(
+            generate(), media_type='text/event-stream', headers=timing_headers)
 
-    def fetch():
-        with httpx.Client(timeout=None) as client:
-            response = client.post(
-                f'{ollama_base_url}/v1/chat/completions',
-                json=body, headers={'Content-Type': 'application/json'},
-            )
-            logger.debug('upstream status: %d', response.status_code)
-            logger.debug('upstream body: %s', response.text[:500])
-            if len(response.text) > 500:
-                logger.debug('upstream body end: ...%s', response.text[500:][-500:])
-            return response.content, response.status_code, dict(response.headers)
-    content, status_code, headers = await asyncio.to_thread(fetch)
+    with timed_stage('upstream'):
+        response = await get_async_http_client().post(
+            f'{ollama_base_url}/v1/chat/completions',
+            json=body, headers={'Content-Type': 'application/json'},
+        )
+    logger.debug('upstream status: %d', response.status_code)
+    logger.debug('upstream body: %s', response.text[:500])
+    if len(response.text) > 500:
+        logger.debug('upstream body end: ...%s', response.text[500:][-500:])
+    content, status_code, headers = response.content, response.status_code, dict(response.headers)
     if log_chat:
         try:
             val = json.loads(content.decode('utf-8').split('data:', 1)[-1].strip())
@@ -1354,6 +3511,8 @@ async def chat_completions(request: fastapi.Request):  # noqa
             chat_logger.info('openai response: %s', json.dumps({'content': val}))
         except Exception:
             pass
+    if timings:
+        headers['server-timing'] = server_timing_header(timings)
     return fastapi.responses.Response(
         content=content, status_code=status_code,
         headers=strip_hop_by_hop_headers(headers),
@@ -1365,30 +3524,51 @@ async def chat_completions(request: fastapi.Request):  # noqa
     methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS', 'HEAD'],
 )
 async def proxy_passthrough(request: fastapi.Request, path: str):
-    log_chat = chat_logger.getEffectiveLevel() <= logging.INFO
-    async with httpx.AsyncClient(timeout=None) as client:
-        content = await request.body()
-        if log_chat and 'generate' in path:
-            chat_logger.info('request: %r', content)
-        response = await client.request(
-            method=request.method,
-            url=f'{config.ollama_base_url}/{path}',
-            headers={k: v for k, v in request.headers.items() if k.lower() != 'host'},
-            content=content,
-            params=request.query_params,
-        )
-    if log_chat and 'generate' in path:
-        val = response.content
+    log_chat = chat_logger.getEffectiveLevel() <= logging.INFO and 'generate' in path
+    request_prefix = bytearray()
+
+    async def request_body():
+        async for chunk in request.stream():
+            if log_chat:
+                tee_prefix(request_prefix, chunk)
+            yield chunk
+
+    has_body = 'content-length' in request.headers or 'transfer-encoding' in request.headers
+    client = get_async_http_client()
+    response = await client.send(client.build_request(
+        method=request.method,
+        url=f'{config.ollama_base_url}/{path}',
+        headers={k: v for k, v in request.headers.items() if k.lower() != 'host'},
+        content=request_body() if has_body else None,
+        params=request.query_params,
+    ), stream=True)
+    if log_chat:
+        chat_logger.info('request: %r', bytes(request_prefix))
+
+    async def response_body():
+        response_prefix = bytearray()
         try:
-            val = json.loads(val.decode('utf-8'))
-            val.pop('context', None)
-        except Exception:
-            pass
-        chat_logger.info('response: %r', val)
-    return fastapi.responses.Response(
-        content=response.content,
+            async for chunk in response.aiter_bytes():
+                if log_chat:
+                    tee_prefix(response_prefix, chunk)
+                yield chunk
+        finally:
+            if path.strip('/') in MODEL_CHANGING_PATHS:
+                model_info_cache.clear()
+            if log_chat:
+                val = bytes(response_prefix)
+                try:
+                    val = json.loads(val.decode('utf-8'))
+                    val.pop('context', None)
+                except Exception:
+                    pass
+                chat_logger.info('response: %r', val)
+
+    return fastapi.responses.StreamingResponse(
+        response_body(),
         status_code=response.status_code,
         headers=strip_hop_by_hop_headers(dict(response.headers)),
+        background=starlette.background.BackgroundTask(response.aclose),
     )
 
 
@@ -1485,56 +3665,72 @@ def cmd_serve(args):
     signal.signal(signal.SIGTERM, handle_signal)
     thread = threading.Thread(target=server.run, daemon=True)
     thread.start()
+    watcher = None
+    if args.watch and source_configs:
+        watcher = SourceWatcher(source_configs, args.watch_debounce)
+        watcher.start()
+    if args.compact_interval > 0 and source_configs:
+        threading.Thread(
+            target=run_compaction, args=(args.compact_interval, args.keep_versions),
+            name='rag-compact', daemon=True).start()
     if args.initial:
-        get_all_collections()
+        warm_up()
+    else:
+        ready_event.set()
     while thread.is_alive():
         thread.join(timeout=0.5)
+    if watcher is not None:
+        watcher.stop()
+    if http_client is not None:
+        http_client.close()
+    if extraction_pool is not None:
+        extraction_pool.shutdown(cancel_futures=True)
     logging.getLogger('uvicorn.error').setLevel(logging.INFO)
     logging.getLogger('uvicorn.access').setLevel(logging.INFO)
 
 
+def clear_data_dir_except(data_dir: Path, keep: Iterable[str]) -> None:
+    for path in data_dir.iterdir():
+        if path.name in keep:
+            continue
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
 def cmd_clear(args):
     data_dir = Path(args.data_dir)
     if not data_dir.exists():
         return
     if not args.purge_inactive:
-        shutil.rmtree(data_dir)
+        collection_handles.clear()
+        chroma_clients.pop(str(data_dir / 'chroma'), None)
+        if args.clear_embedding_cache:
+            shutil.rmtree(data_dir)
+        else:
+            clear_data_dir_except(data_dir, EMBEDDING_CACHE_FILES)
         print('Cleared.')
         return
     chroma_dir = data_dir / 'chroma'
     if not chroma_dir.exists():
         return
-    index = load_file_index(data_dir)
-    if not index:
-        return
-    chroma_client = chromadb.PersistentClient(path=str(chroma_dir))
     total_deleted = 0
-    for cname, coll_entry in index.items():
+    for (cname, ) in file_index_db(data_dir).execute('SELECT name FROM collections').fetchall():
         try:
-            collection = chroma_client.get_collection(cname)
+            collection = get_collection_handle(data_dir, cname)
         except Exception:
             continue
-        files_entry = coll_entry.get('files', {})
-        ids_to_delete = []
-        files_to_remove = []
-        for fp, file_entry in files_entry.items():
-            if fp == '__manifest__':
-                continue
-            active_sha = file_entry.get('active_sha', '')
-            versions = file_entry.get('versions', {})
-            for sha in [sha for sha in versions if sha != active_sha]:
-                ids_to_delete.extend(versions.pop(sha))
-            if not active_sha:
-                files_to_remove.append(fp)
-        delete_chunks(collection, ids_to_delete)
-        for fp in files_to_remove:
-            del files_entry[fp]
-        total_deleted += len(ids_to_delete)
+        stats = compact_collection(collection, data_dir, cname, args.keep_versions)
+        total_deleted += stats['chunks']
+        if not stats['versions']:
+            continue
         print(
-            f'Collection {cname}: deleted {len(ids_to_delete)} inactive chunks, '
-            f'removed {len(files_to_remove)} deleted-file entries.',
+            f'Collection {cname}: deleted {stats["chunks"]} chunks of '
+            f'{stats["versions"]} inactive versions, Chroma directory '
+            f'{stats["bytes"]} bytes smaller, '
+            f'probe query {stats["query_ms"][0]:.1f} ms -> {stats["query_ms"][1]:.1f} ms.',
         )
-    save_file_index(data_dir, index)
     print(f'Total chunks deleted: {total_deleted}.')
 
 
@@ -1544,7 +3740,7 @@ def cmd_mcp(args):
     config = args
     source_configs = build_source_configs(args)
     if args.initial:
-        get_all_collections()
+        warm_up()
     server = create_mcp_server()
 
     async def run():
@@ -1598,11 +3794,84 @@ def build_arg_parser() -> argparse.ArgumentParser:
         '--completion-log', '--chat-log',
         help='Folder for storing rotated completion logs with the queries '
         'and responses that come through the completion endpoint.')
+    serve.add_argument(
+        '--watch', action='store_true',
+        help='Watch sources for changes and sync them in the background '
+        'rather than when the next request arrives.',
+    )
+    serve.add_argument(
+        '--watch-debounce', type=float,
+        default=float(os.environ.get('RAG_WATCH_DEBOUNCE', '1')),
+        help='Seconds without further changes before a watched source is '
+        'synced; default is 1',
+    )
+    serve.add_argument(
+        '--server-timing', action='store_true',
+        help='Add a Server-Timing header with the duration of each retrieval '
+        'stage to chat completion responses.  Streaming responses only include '
+        'the stages before the upstream request.',
+    )
+    serve.add_argument(
+        '--compact-interval', type=float,
+        default=float(os.environ.get('RAG_COMPACT_INTERVAL', '3600')),
+        help='Seconds between compactions that delete the chunks of old '
+        'inactive file versions; default is 3600.  0 disables compaction.',
+    )
+    serve.add_argument(
+        '--keep-versions', type=int,
+        default=int(os.environ.get('RAG_KEEP_VERSIONS', '2')),
+        help='Number of the most recent inactive versions of each file that '
+        'compaction keeps so they can be reactivated without re-embedding; '
+        'default is 2',
+    )
     clear.add_argument(
         '--purge-inactive', action='store_true',
         help='Remove inactive chunks and deleted-file entries without destroying active data',
     )
+    clear.add_argument(
+        '--keep-versions', type=int, default=0,
+        help='With --purge-inactive, keep this many of the most recent inactive '
+        'versions of each file; default is 0',
+    )
+    clear.add_argument(
+        '--clear-embedding-cache', action='store_true',
+        help='Also remove the cache of computed embeddings and extracted '
+        'document text.  By default it is kept so that rebuilding collections '
+        'does not re-extract or re-embed unchanged files.',
+    )
     for sub in (serve, mcp):
+        sub.add_argument(
+            '--embedding-cache-size', type=int,
+            default=int(os.environ.get('RAG_EMBEDDING_CACHE_SIZE', '500000')),
+            help='Maximum number of computed embeddings kept in the data '
+            'directory and shared by all collections; the least recently used '
+            'are evicted.  Default is 500000.  0 disables the cache, '
+            'including extracted document text.',
+        )
+        sub.add_argument(
+            '--model-info-ttl', type=float,
+            default=float(os.environ.get('RAG_MODEL_INFO_TTL', '300')),
+            help='Seconds to trust cached model metadata before checking the '
+            "model's digest with Ollama; default is 300",
+        )
+        sub.add_argument(
+            '--http-max-connections', type=int,
+            default=int(os.environ.get('RAG_HTTP_MAX_CONNECTIONS', '100')),
+            help='Maximum number of concurrent connections to Ollama; default '
+            'is 100',
+        )
+        sub.add_argument(
+            '--http-max-keepalive', type=int,
+            default=int(os.environ.get('RAG_HTTP_MAX_KEEPALIVE', '20')),
+            help='Maximum number of idle connections to Ollama kept open for '
+            'reuse; default is 20',
+        )
+        sub.add_argument(
+            '--http-keepalive-expiry', type=float,
+            default=float(os.environ.get('RAG_HTTP_KEEPALIVE_EXPIRY', '30')),
+            help='Seconds an idle connection to Ollama is kept open; default '
+            'is 30',
+        )
         sub.add_argument(
             '--ollama-base-url',
             default=os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434'),
@@ -1682,10 +3951,83 @@ def build_arg_parser() -> argparse.ArgumentParser:
             default=int(os.environ.get('RAG_CHUNK_OVERLAP', '64')),
             help='Embedding chunk overlap; default is 64',
         )
+        sub.add_argument(
+            '--embed-batch-size', type=int,
+            default=int(os.environ.get('RAG_EMBED_BATCH_SIZE', '32')),
+            help='Number of chunks sent to Ollama in each embedding request; '
+            'default is 32.  Chunks from multiple files are packed together.',
+        )
+        sub.add_argument(
+            '--embed-concurrency', type=int,
+            default=int(os.environ.get('RAG_EMBED_CONCURRENCY', '2')),
+            help='Maximum number of embedding requests in flight at once; '
+            'default is 2',
+        )
+        sub.add_argument(
+            '--load-workers', type=int,
+            default=int(os.environ.get('RAG_LOAD_WORKERS', '4')),
+            help='Number of threads loading and chunking files while '
+            'embedding; default is 4',
+        )
+        sub.add_argument(
+            '--extract-workers', type=int,
+            default=int(os.environ.get('RAG_EXTRACT_WORKERS', '2')),
+            help='Number of worker processes converting PDF, DOCX and pandoc '
+            'documents to text; default is 2.  0 extracts in the loading '
+            'threads instead.',
+        )
+        sub.add_argument(
+            '--extract-timeout', type=float,
+            default=float(os.environ.get('RAG_EXTRACT_TIMEOUT', '120')),
+            help='Seconds an extraction worker may spend on one document; '
+            'default is 120.  0 disables the limit.',
+        )
+        sub.add_argument(
+            '--extract-memory-limit', type=int,
+            default=int(os.environ.get('RAG_EXTRACT_MEMORY_LIMIT', '2048')),
+            help='Memory limit in MB of each extraction worker process, '
+            'including pandoc; default is 2048.  0 disables the limit.',
+        )
+        sub.add_argument(
+            '--extract-cache-size', type=int,
+            default=int(os.environ.get('RAG_EXTRACT_CACHE_SIZE', '512')),
+            help='Maximum MB of compressed extracted document text kept in '
+            'the embedding cache; the least recently used are evicted.  '
+            'Default is 512.  0 disables caching extracted text.',
+        )
+        sub.add_argument(
+            '--query-cache-size', type=int,
+            default=int(os.environ.get('RAG_QUERY_CACHE_SIZE', '256')),
+            help='Number of query embeddings to keep for repeated queries; '
+            'default is 256.  0 disables the cache.',
+        )
+        sub.add_argument(
+            '--query-cache-ttl', type=float,
+            default=float(os.environ.get('RAG_QUERY_CACHE_TTL', '600')),
+            help='Seconds a cached query embedding or retrieval result is '
+            'reused; default is 600',
+        )
+        sub.add_argument(
+            '--retrieval-cache-size', type=int,
+            default=int(os.environ.get('RAG_RETRIEVAL_CACHE_SIZE', '128')),
+            help='Number of formatted retrieval results to keep for repeated '
+            'queries against an unchanged index; default is 128.  0 disables '
+            'the cache.',
+        )
+        sub.add_argument(
+            '--freshness-interval', type=float,
+            default=float(os.environ.get('RAG_FRESHNESS_INTERVAL', '30')),
+            help='Seconds to trust the last full check of a source.  After '
+            'this, sources whose directory and git metadata are unchanged are '
+            'rehashed in the background, and changed sources before the '
+            'request.  0 rehashes every source on every request; default is 30.',
+        )
         sub.add_argument(
             '--initial', action='store_true',
             help='Immediately embed source data on initial start rather than '
-            'waiting for a query',
+            'waiting for a query.  Sources are synced in parallel, their '
+            'indexes are loaded, and the embedding model is preloaded; '
+            '/rag/ready reports when this is done.',
         )
         sub.set_defaults(
             git_extensions_default=git_extension_default,
@@ -1698,6 +4040,7 @@ def main():  # noqa
     parser = build_arg_parser()
     args = parser.parse_args()
     logger.setLevel(max(1, logging.WARNING - args.verbose * 10))
+    logging.getLogger('httpx').setLevel(logging.WARNING)
     if hasattr(args, 'source_path') and not args.source_path:
         env_paths = os.environ.get('RAG_SOURCE_PATH', '')
         if env_paths: